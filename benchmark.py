@@ -0,0 +1,487 @@
+# -*- coding: utf-8 -*-
+"""Нагрузочный стенд для bot.py.
+
+Поднимает локальные заглушки Telegram Bot API и OpenWeatherMap (с настраиваемой
+задержкой и долей ошибок), запускает Flask-приложение бота на свободном порту и
+прогоняет сценарии:
+
+- поток апдейтов (создание напоминаний, список, колбэки, настройки) с заданной частотой;
+- утренняя рассылка погоды на N подписчиков;
+- запись в хранилище и restore_jobs на большом объеме напоминаний.
+
+Печатает пропускную способность, p50/p99 задержек, пиковую память и время записи.
+Для апдейтов задержка считается дважды: ответ вебхука (только постановка в
+очередь) и обработка — от приема апдейта до конца работы обработчика.
+
+Пример:
+    python benchmark.py --updates 2000 --rate 200 --subscribers 5000 --reminders 20000
+"""
+
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+import threading
+import resource
+from time import sleep, monotonic, perf_counter
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import requests
+
+BENCH_TOKEN = "123456:BENCHMARK"
+
+# === 1. Заглушки внешних сервисов ===
+
+class FakeService:
+    """HTTP-сервер в отдельном потоке с задержкой и долей ошибок на каждый запрос."""
+
+    def __init__(self, handler_factory, latency, error_rate):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler_factory(self))
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def should_fail(self):
+        with self._lock:
+            self.requests += 1
+            failed = random.random() < self.error_rate
+            self.errors += failed
+        if self.latency:
+            sleep(self.latency)
+        return failed
+
+
+def _read_params(handler):
+    """Параметры запроса из query string и из тела (form или JSON)."""
+    url = urlparse(handler.path)
+    params = {key: values[0] for key, values in parse_qs(url.query).items()}
+    length = int(handler.headers.get("Content-Length") or 0)
+    if length:
+        body = handler.rfile.read(length).decode("utf-8", errors="replace")
+        if handler.headers.get("Content-Type", "").startswith("application/json"):
+            params.update(json.loads(body))
+        else:
+            params.update({key: values[0] for key, values in parse_qs(body).items()})
+    return url.path, params
+
+
+def _reply(handler, status, payload):
+    body = json.dumps(payload).encode("utf-8")
+    handler.send_response(status)
+    handler.send_header("Content-Type", "application/json")
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+def telegram_handler(service):
+    message_ids = iter(range(1, 10 ** 9))
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _handle(self):
+            path, params = _read_params(self)
+            if service.should_fail():
+                _reply(self, 429, {"ok": False, "error_code": 429, "description": "Too Many Requests", "parameters": {"retry_after": 1}})
+                return
+            method = path.rsplit("/", 1)[-1]
+            if method in ("sendMessage", "editMessageText", "sendDocument"):
+                chat_id = int(params.get("chat_id", 0))
+                result = {"message_id": next(message_ids), "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+            else:
+                result = True
+            _reply(self, 200, {"ok": True, "result": result})
+
+        do_GET = _handle
+        do_POST = _handle
+
+    return Handler
+
+
+def weather_handler(service):
+    forecast = {"list": [
+        {"dt": 1700000000 + i * 3 * 3600, "main": {"temp": 10 + i}, "weather": [{"description": "облачно"}]}
+        for i in range(8)
+    ]}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            path, params = _read_params(self)
+            if service.should_fail():
+                _reply(self, 503, {"cod": 503, "message": "unavailable"})
+                return
+            if path.endswith("/weather"):
+                name = params.get("q", "").strip()
+                _reply(self, 200, {"id": abs(hash(name.casefold())) % 10 ** 7, "name": name, "coord": {"lat": 55.7, "lon": 37.6}})
+            else:
+                _reply(self, 200, forecast)
+
+    return Handler
+
+
+# === 2. Синтетические апдейты ===
+
+class UpdateFactory:
+    def __init__(self):
+        self._ids = iter(range(1, 10 ** 9))
+
+    def message(self, user_id, text):
+        update_id = next(self._ids)
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(datetime.now().timestamp()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+                "text": text,
+            },
+        }
+
+    def callback(self, user_id, data):
+        update_id = next(self._ids)
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": update_id,
+                    "date": 0,
+                    "chat": {"id": user_id, "type": "private"},
+                    "text": "🔔 Напоминание",
+                },
+            },
+        }
+
+    def session(self, user_id):
+        """Типичный сеанс пользователя: порядок важен, поэтому апдейты идут цепочкой."""
+        minute = random.randint(0, 59)
+        return [
+            self.message(user_id, "/start"),
+            self.message(user_id, "➕ Добавить напоминание"),
+            self.message(user_id, f"{random.randint(0, 23):02d}:{minute:02d} Созвон {random.randint(1, 999)}"),
+            self.message(user_id, "➕ Добавить напоминание"),
+            self.message(user_id, "\n".join(f"{(minute + i) % 24:02d}:30 Задача {i}" for i in range(5))),
+            self.message(user_id, "📋 Мои напоминания"),
+            self.message(user_id, "🌤 Погода"),
+            self.message(user_id, "⚙️ Настройки погоды"),
+            self.message(user_id, "⏰ Изменить время"),
+            self.message(user_id, f"{random.randint(6, 9):02d}:{random.choice(['00', '30'])}"),
+            self.message(user_id, "✅ Включить уведомления"),
+            self.message(user_id, "↩️ Назад в меню"),
+        ]
+
+
+# === 3. Измерения ===
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+class LatencyRecorder:
+    """Копит значения гистограмм бота, чтобы посчитать точные перцентили.
+
+    Бакеты гистограмм для p50/p99 слишком грубые, поэтому наблюдения
+    перехватываются на входе в metrics.observe и дальше передаются как есть.
+    """
+
+    def __init__(self, metrics, names):
+        self.samples = {name: [] for name in names}
+        self._observe = metrics.observe
+        metrics.observe = self.observe
+
+    def observe(self, name, value, **labels):
+        samples = self.samples.get(name)
+        if samples is not None:
+            samples.append(value)
+        self._observe(name, value, **labels)
+
+    def take(self, name):
+        """Значения, накопленные с прошлого вызова."""
+        values, self.samples[name] = self.samples[name], []
+        return values
+
+
+def peak_memory_mb():
+    # На Linux ru_maxrss в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def replay(webhook_url, updates, rate, clients):
+    """Отправляет апдейты в вебхук с частотой rate/с. Возвращает задержки ответов и число отказов."""
+    jobs = list(enumerate(updates))
+    lock = threading.Lock()
+    latencies, rejected = [], []
+    started = monotonic()
+
+    def worker():
+        session = requests.Session()
+        while True:
+            with lock:
+                if not jobs:
+                    return
+                i, update = jobs.pop(0)
+            delay = started + i / rate - monotonic()
+            if delay > 0:
+                sleep(delay)
+            sent = perf_counter()
+            response = session.post(webhook_url, json=update)
+            elapsed = perf_counter() - sent
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code != 200:
+                    rejected.append(response.status_code)
+
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, rejected
+
+
+def interleave(sessions):
+    """Перемешивает сеансы пользователей, сохраняя порядок внутри каждого."""
+    pending = [list(session) for session in sessions]
+    result = []
+    while pending:
+        session = random.choice(pending)
+        result.append(session.pop(0))
+        if not session:
+            pending.remove(session)
+    return result
+
+
+# === 4. Сценарии ===
+
+def run_updates(bot_module, webhook_url, recorder, args, results):
+    factory = UpdateFactory()
+    users = [10 ** 6 + i for i in range(args.users)]
+    sessions = [factory.session(user_id) for user_id in users]
+    updates = interleave(sessions)[:args.updates]
+
+    recorder.take("bot_update_seconds")
+    started = monotonic()
+    latencies, rejected = replay(webhook_url, updates, args.rate, args.clients)
+    bot_module.update_dispatcher.join()
+    elapsed = monotonic() - started
+    processing = recorder.take("bot_update_seconds")
+    results["updates"] = {
+        "count": len(updates),
+        "rejected": len(rejected),
+        "seconds": elapsed,
+        "throughput_per_s": len(updates) / elapsed,
+        "ack_p50_ms": percentile(latencies, 50) * 1000,
+        "ack_p99_ms": percentile(latencies, 99) * 1000,
+        "processing_p50_ms": percentile(processing, 50) * 1000,
+        "processing_p99_ms": percentile(processing, 99) * 1000,
+    }
+
+    # Колбэки «Выполнено/Удалить» по только что созданным напоминаниям
+    callbacks = []
+    for user_id in users:
+        for rem in bot_module.reminders.for_user(user_id):
+            callbacks.append(factory.callback(user_id, f"rem_{random.choice(['done', 'delete'])}_{rem.id}"))
+    started = monotonic()
+    latencies, rejected = replay(webhook_url, callbacks, args.rate, args.clients)
+    bot_module.update_dispatcher.join()
+    elapsed = monotonic() - started
+    processing = recorder.take("bot_update_seconds")
+    results["callbacks"] = {
+        "count": len(callbacks),
+        "rejected": len(rejected),
+        "seconds": elapsed,
+        "throughput_per_s": len(callbacks) / elapsed if elapsed else 0.0,
+        "ack_p50_ms": percentile(latencies, 50) * 1000,
+        "ack_p99_ms": percentile(latencies, 99) * 1000,
+        "processing_p50_ms": percentile(processing, 50) * 1000,
+        "processing_p99_ms": percentile(processing, 99) * 1000,
+    }
+
+
+def run_weather_burst(bot_module, telegram, weather, recorder, args, results):
+    cities = [f"Город {i}" for i in range(args.cities)]
+    bot_module.weather_index.clear()
+    for i in range(args.subscribers):
+        user_id = str(2 * 10 ** 6 + i)
+        bot_module.user_settings[user_id] = {"city": random.choice(cities), "notification_time": "07:30", "notifications_on": True}
+        bot_module.schedule_weather_job(user_id)
+    sent_before = telegram.requests
+    weather_before = weather.requests
+
+    bot_module.outbox.join()
+    recorder.take("bot_outbox_delivery_seconds")
+    started = monotonic()
+    bot_module.send_weather_bucket("07:30")
+    fanout_done = monotonic()
+    bot_module.outbox.join()
+    elapsed = monotonic() - started
+    # От постановки сообщения в очередь до ответа Telegram
+    delivery = recorder.take("bot_outbox_delivery_seconds")
+    results["weather_burst"] = {
+        "subscribers": args.subscribers,
+        "cities": args.cities,
+        "upstream_requests": weather.requests - weather_before,
+        "telegram_requests": telegram.requests - sent_before,
+        "fanout_seconds": fanout_done - started,
+        "delivery_seconds": elapsed,
+        "messages_per_s": args.subscribers / elapsed,
+        "delivery_p50_ms": percentile(delivery, 50) * 1000,
+        "delivery_p99_ms": percentile(delivery, 99) * 1000,
+    }
+
+
+def run_storage(bot_module, args, results):
+    Reminder = bot_module.Reminder
+    now = datetime.now(bot_module.utc)
+    bulk = [
+        Reminder(f"bench-{i}", str(3 * 10 ** 6 + i % 1000), now + timedelta(minutes=random.randint(1, 60 * 24 * 30)), f"Задача {i}")
+        for i in range(args.reminders)
+    ]
+    for rem in bulk:
+        bot_module.reminders.add(rem)
+    started = perf_counter()
+    bot_module.storage.save_reminders(bulk)
+    bulk_seconds = perf_counter() - started
+
+    # Одиночные записи — то, что происходит на каждое нажатие кнопки
+    single = []
+    for i in range(args.single_writes):
+        rem = Reminder(f"single-{i}", "3000000", now + timedelta(hours=1), "Одиночная запись")
+        bot_module.reminders.add(rem)
+        started = perf_counter()
+        bot_module.storage.save_reminder(rem)
+        single.append(perf_counter() - started)
+
+    started = perf_counter()
+    bot_module.restore_jobs()
+    restore_seconds = perf_counter() - started
+    results["storage"] = {
+        "backend": bot_module.STORAGE_BACKEND,
+        "reminders": len(bot_module.reminders),
+        "bulk_write_seconds": bulk_seconds,
+        "single_write_p50_ms": percentile(single, 50) * 1000,
+        "single_write_p99_ms": percentile(single, 99) * 1000,
+        "restore_jobs_seconds": restore_seconds,
+    }
+
+
+# === 5. Запуск ===
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд для bot.py")
+    parser.add_argument("--updates", type=int, default=2000, help="сколько апдейтов отправить в вебхук")
+    parser.add_argument("--rate", type=float, default=200, help="частота отправки апдейтов, шт/с")
+    parser.add_argument("--clients", type=int, default=8, help="параллельных HTTP-клиентов")
+    parser.add_argument("--users", type=int, default=200, help="разных пользователей в потоке апдейтов")
+    parser.add_argument("--subscribers", type=int, default=5000, help="подписчиков в утренней рассылке")
+    parser.add_argument("--cities", type=int, default=50, help="разных городов у подписчиков")
+    parser.add_argument("--reminders", type=int, default=20000, help="напоминаний для сценария хранилища")
+    parser.add_argument("--single-writes", type=int, default=200, help="одиночных записей в хранилище")
+    parser.add_argument("--storage", choices=["sqlite", "json"], default="sqlite")
+    parser.add_argument("--telegram-latency", type=float, default=0.005, help="задержка заглушки Telegram, с")
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--telegram-rate", type=float, default=1000, help="TELEGRAM_GLOBAL_RATE для бота")
+    parser.add_argument("--weather-latency", type=float, default=0.05, help="задержка заглушки OpenWeatherMap, с")
+    parser.add_argument("--weather-error-rate", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--throttle", action="store_true", help="оставить боевые лимиты частоты запросов пользователей")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="сохранить результаты в JSON-файл")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    telegram = FakeService(telegram_handler, args.telegram_latency, args.telegram_error_rate)
+    weather = FakeService(weather_handler, args.weather_latency, args.weather_error_rate)
+
+    # Бот читает конфигурацию из окружения при импорте, поэтому настраиваем его до import
+    workdir = tempfile.mkdtemp(prefix="bot-bench-")
+    os.chdir(workdir)
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "WEATHER_API_URL": weather.url,
+        "STORAGE_BACKEND": args.storage,
+        "DB_PATH": os.path.join(workdir, "bot.sqlite3"),
+        "JOBS_DB_PATH": "",
+        "TELEGRAM_GLOBAL_RATE": str(args.telegram_rate),
+        "TELEGRAM_CHAT_RATE": str(args.telegram_rate),
+    })
+    if not args.throttle:
+        # Синтетические пользователи жмут кнопки гораздо чаще живых
+        for action in ("weather", "reminder", "callback", "default"):
+            os.environ[f"THROTTLE_{action.upper()}"] = "1000000/1000000/1000000"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    import telebot
+    import bot as bot_module
+    from werkzeug.serving import make_server
+
+    logging.disable(logging.WARNING)
+    telebot.apihelper.API_URL = telegram.url + "/bot{0}/{1}"
+    recorder = LatencyRecorder(bot_module.metrics, ("bot_update_seconds", "bot_outbox_delivery_seconds"))
+
+    bot_module.outbox.start()
+    bot_module.update_dispatcher.start()
+    bot_module.scheduler.start(paused=True)
+    bot_module.restore_jobs()
+    bot_module.scheduler.resume()
+
+    server = make_server("127.0.0.1", 0, bot_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    webhook_url = f"http://127.0.0.1:{server.server_port}/{BENCH_TOKEN}"
+
+    results = {}
+    for name, scenario in (
+        ("апдейты", lambda: run_updates(bot_module, webhook_url, recorder, args, results)),
+        ("рассылка погоды", lambda: run_weather_burst(bot_module, telegram, weather, recorder, args, results)),
+        ("хранилище", lambda: run_storage(bot_module, args, results)),
+    ):
+        print(f"→ {name}...", file=sys.stderr)
+        scenario()
+    results["peak_memory_mb"] = peak_memory_mb()
+    server.shutdown()
+    bot_module.scheduler.shutdown(wait=False)
+
+    for section, values in results.items():
+        if isinstance(values, dict):
+            print(f"[{section}]")
+            for key, value in values.items():
+                print(f"  {key:24} {value:.3f}" if isinstance(value, float) else f"  {key:24} {value}")
+        else:
+            print(f"{section:26} {values:.1f}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,16 +5,37 @@ import os
 import logging
 import json
 import re
+import sqlite3
+import csv
+import io
 import uuid
 import threading
-from time import sleep
+import queue
+import random
+import itertools
+import bisect
+import heapq
+import calendar
+import functools
+import pickle
+import socket
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import sleep, monotonic, time
 from datetime import datetime, timedelta
 
 import requests
+from requests.adapters import HTTPAdapter
 from flask import Flask, request
 import telebot
 from telebot import types
+from telebot.apihelper import ApiTelegramException
+from telebot.handler_backends import HandlerBackend
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED
+from sqlalchemy import func, select
 from pytz import timezone, utc
 
 # --- Настройка логирования ---
@@ -29,24 +50,343 @@ BOT_TOKEN = os.environ.get("BOT_TOKEN", "ВАШ_ТОКЕН_ЗДЕСЬ")
 WEATHER_API_KEY = os.environ.get("WEATHER_API_KEY", "7c70d84340f4e9b9e99874cd465aefa8")
 ADMIN_ID = 941791842
 WEBHOOK_URL = 'https://din-js6l.onrender.com'
+# Прогноз OpenWeatherMap обновляется раз в ~3 часа, поэтому кэшируем его по городу
+FORECAST_CACHE_TTL = int(os.environ.get("FORECAST_CACHE_TTL", 1800))  # секунды
+FORECAST_CACHE_SIZE = int(os.environ.get("FORECAST_CACHE_SIZE", 512))  # максимум городов в кэше
+# HTTP-клиент OpenWeatherMap: пул соединений, повторы и предохранитель (circuit breaker)
+WEATHER_API_URL = os.environ.get("WEATHER_API_URL", "https://api.openweathermap.org")
+WEATHER_TIMEOUT = float(os.environ.get("WEATHER_TIMEOUT", 5))
+WEATHER_POOL_SIZE = int(os.environ.get("WEATHER_POOL_SIZE", 10))
+WEATHER_MAX_RETRIES = int(os.environ.get("WEATHER_MAX_RETRIES", 2))
+WEATHER_DEADLINE = float(os.environ.get("WEATHER_DEADLINE", 8))  # общий бюджет на запрос вместе с повторами, секунды
+WEATHER_BREAKER_THRESHOLD = int(os.environ.get("WEATHER_BREAKER_THRESHOLD", 5))  # ошибок подряд до размыкания
+WEATHER_BREAKER_COOLDOWN = float(os.environ.get("WEATHER_BREAKER_COOLDOWN", 60))  # секунд до пробного запроса
+WEATHER_CATCHUP_MINUTES = int(os.environ.get("WEATHER_CATCHUP_MINUTES", 5))  # сколько пропущенных минут рассылки досылать
+# Лимиты Telegram: ~30 сообщений/с на бота и ~1 сообщение/с в один чат
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", 25))
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", 1))
+OUTBOX_SIZE = int(os.environ.get("OUTBOX_SIZE", 10000))
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", 4))
+OUTBOX_MAX_RETRIES = int(os.environ.get("OUTBOX_MAX_RETRIES", 3))
+# Обработка входящих апдейтов вне запроса вебхука
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", 4))
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", 1000))
+UPDATE_DEDUP_SIZE = int(os.environ.get("UPDATE_DEDUP_SIZE", 10000))  # сколько последних update_id помнить
+# Ограничение частоты апдейтов до постановки в очередь. Для каждого класса действий
+# "в минуту на пользователя/запас на пользователя/в секунду на всех", например THROTTLE_WEATHER="6/3/5"
+THROTTLE_LIMITS = {
+    action: tuple(float(value) for value in os.environ.get(f"THROTTLE_{action.upper()}", default).split("/"))
+    for action, default in (
+        ("weather", "6/3/5"),  # каждый запрос — обращение к OpenWeatherMap
+        ("reminder", "20/10/20"),
+        ("callback", "60/20/30"),
+        ("default", "60/20/50"),
+    )
+}
+THROTTLE_IDLE_SECONDS = int(os.environ.get("THROTTLE_IDLE_SECONDS", 600))  # через сколько забывать неактивных пользователей
+THROTTLE_NOTICE_INTERVAL = int(os.environ.get("THROTTLE_NOTICE_INTERVAL", 30))  # не чаще одного предупреждения за столько секунд
+# При старте в планировщик попадают только напоминания ближайших RESTORE_HORIZON_HOURS часов,
+# остальные раз в PROMOTE_INTERVAL_MINUTES минут догружаются фоновой задачей
+RESTORE_HORIZON_HOURS = int(os.environ.get("RESTORE_HORIZON_HOURS", 6))
+PROMOTE_INTERVAL_MINUTES = int(os.environ.get("PROMOTE_INTERVAL_MINUTES", 15))
+# Сработавшие напоминания хранятся столько часов (чтобы успеть нажать «Выполнено»), потом удаляются
+REMINDER_RETENTION_HOURS = int(os.environ.get("REMINDER_RETENTION_HOURS", 72))
+# Напоминания, пропущенные во время простоя не дольше MISSED_GRACE_HOURS, досылаются при старте.
+# MISSED_POLICY: "batch" — одним сообщением на пользователя, "each" — каждое отдельно, "skip" — не досылать
+MISSED_GRACE_HOURS = float(os.environ.get("MISSED_GRACE_HOURS", 12))
+MISSED_POLICY = os.environ.get("MISSED_POLICY", "batch")
+# Массовый импорт напоминаний (несколько строк или .txt/.csv файл)
+BULK_IMPORT_MAX_LINES = int(os.environ.get("BULK_IMPORT_MAX_LINES", 200))
+BULK_IMPORT_MAX_BYTES = int(os.environ.get("BULK_IMPORT_MAX_BYTES", 64 * 1024))
+# Хранилище: "sqlite" (по умолчанию) или "json" для совсем маленьких установок
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sqlite")
+DB_PATH = os.environ.get("DB_PATH", "bot.sqlite3")
+# Постоянное хранилище задач планировщика; пустое значение — задачи только в памяти
+JOBS_DB_PATH = os.environ.get("JOBS_DB_PATH", "jobs.sqlite3")
+REMINDERS_FILE = 'reminders.json'
+SETTINGS_FILE = 'user_settings.json'
+CITIES_FILE = 'cities.json'
+# Неизвестные названия городов запоминаются на сутки, найденные — навсегда
+CITY_NEGATIVE_TTL = int(os.environ.get("CITY_NEGATIVE_TTL", 24 * 3600))
+# Несколько экземпляров за одним вебхуком: состояние и диалоги в общей базе DB_PATH,
+# задачи в общем JOBS_DB_PATH, планировщик работает только у держателя аренды
+CLUSTER_MODE = os.environ.get("CLUSTER_MODE", "0") == "1"
+INSTANCE_ID = os.environ.get("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+LEADER_LEASE_SECONDS = float(os.environ.get("LEADER_LEASE_SECONDS", 15))  # через сколько аренда умершего ведущего освобождается
+LEADER_RENEW_SECONDS = float(os.environ.get("LEADER_RENEW_SECONDS", 3))  # как часто продлевать аренду и будить планировщик
 
 # --- Инициализация ---
-bot = telebot.TeleBot(BOT_TOKEN)
+# threaded=False: обработчики выполняются в потоках UpdateDispatcher, сохраняющих порядок внутри чата
+bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
 app = Flask(__name__)
-scheduler = BackgroundScheduler(timezone=utc)
+
+def create_jobstore():
+    if CLUSTER_MODE and not JOBS_DB_PATH:
+        raise RuntimeError("CLUSTER_MODE требует общего хранилища задач JOBS_DB_PATH.")
+    if not JOBS_DB_PATH:
+        return MemoryJobStore()
+    return SQLAlchemyJobStore(url=f"sqlite:///{JOBS_DB_PATH}")
+
+jobstore = create_jobstore()
+scheduler = BackgroundScheduler(timezone=utc, jobstores={'default': jobstore})
 moscow_tz = timezone('Europe/Moscow')
 
+# --- Метрики ---
+
+class Metrics:
+    """Минимальный реестр метрик, отдаваемый в текстовом формате Prometheus на /metrics."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._meta = {}  # name -> (type, help)
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [попадания в бакеты (последний — +Inf), sum, count]
+        self._gauges = {}  # name -> функция без аргументов
+        self._lock = threading.Lock()
+
+    def counter(self, name, help_text):
+        self._meta[name] = ("counter", help_text)
+
+    def histogram(self, name, help_text):
+        self._meta[name] = ("histogram", help_text)
+
+    def gauge(self, name, help_text, callback):
+        """Gauge вычисляется в момент запроса /metrics."""
+        self._meta[name] = ("gauge", help_text)
+        self._gauges[name] = callback
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.BUCKETS, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - started, **labels)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in pairs) + "}"
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(series[0]), series[1], series[2]) for key, series in self._histograms.items()}
+        lines = []
+        for name, (metric_type, help_text) in sorted(self._meta.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type == "counter":
+                for (series_name, labels), value in counters.items():
+                    if series_name == name:
+                        lines.append(f"{name}{self._labels(labels)} {value}")
+            elif metric_type == "histogram":
+                for (series_name, labels), (buckets, total, count) in histograms.items():
+                    if series_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, bucket_count in zip(self.BUCKETS, buckets):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                    lines.append(f"{name}_count{self._labels(labels)} {count}")
+            else:
+                try:
+                    lines.append(f"{name} {self._gauges[name]()}")
+                except Exception as e:
+                    logger.warning(f"Не удалось вычислить метрику {name}: {e}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.histogram("bot_webhook_seconds", "Время обработки запроса вебхука")
+metrics.counter("bot_route_total", "Текстовые сообщения по обработчикам (match: exact — надпись кнопки, pattern — регулярное выражение)")
+metrics.counter("bot_throttled_total", "Апдейты, отброшенные ограничением частоты (scope: user или global)")
+metrics.histogram("bot_handler_seconds", "Время выполнения обработчиков сообщений")
+metrics.histogram("bot_update_seconds", "Время от приема апдейта вебхуком до конца его обработки")
+metrics.histogram("bot_forecast_seconds", "Время получения прогноза (source: cache, upstream, stale)")
+metrics.histogram("bot_storage_write_seconds", "Длительность записи в хранилище")
+metrics.counter("bot_storage_bytes_written_total", "Байт записано в JSON-файлы")
+metrics.histogram("bot_job_lag_seconds", "Задержка запуска задач планировщика относительно расписания")
+metrics.counter("bot_job_errors_total", "Задачи планировщика, завершившиеся ошибкой")
+metrics.counter("bot_job_missed_total", "Задачи планировщика, пропущенные из-за опоздания")
+metrics.histogram("bot_outbox_send_seconds", "Длительность вызова sendMessage")
+metrics.histogram("bot_outbox_wait_seconds", "Время ожидания сообщения в очереди отправки")
+metrics.histogram("bot_outbox_delivery_seconds", "Время от постановки сообщения в очередь до ответа Telegram")
+metrics.counter("bot_outbox_failures_total", "Сообщения, которые не удалось отправить")
+metrics.counter("bot_outbox_retries_total", "Повторные попытки отправки (429, 5xx, сетевые ошибки)")
+metrics.counter("bot_outbox_dropped_total", "Сообщения, отброшенные из-за переполненной очереди отправки")
+metrics.counter("bot_updates_total", "Апдейты вебхука (result: accepted, duplicate — повтор Telegram, rejected — ответ 503)")
+metrics.counter("bot_cache_requests_total", "Обращения к кэшам прогнозов (result: hit, miss, coalesced — дождался чужой загрузки)")
+metrics.histogram("bot_weather_api_seconds", "Длительность запросов к OpenWeatherMap")
+
 # --- Глобальные хранилища ---
-reminders = {}
 user_settings = {}  # { "user_id": {"city": "Москва", "notification_time": "07:30", "notifications_on": False}}
 
 # === 2. Управление данными (сохранение и загрузка) ===
 
+class Reminder:
+    """Компактная запись напоминания; time — aware datetime в UTC.
+
+    У повторяющегося напоминания rule — правило повтора (см. next_occurrence),
+    а time — ближайшее срабатывание.
+    """
+    __slots__ = ("id", "user_id", "time", "text", "delivered", "rule")
+
+    def __init__(self, reminder_id, user_id, time, text, delivered=False, rule=None):
+        self.id = reminder_id
+        self.user_id = str(user_id)
+        self.time = time
+        self.text = text
+        self.delivered = delivered
+        self.rule = rule
+
+    @classmethod
+    def from_dict(cls, data):
+        time = datetime.fromisoformat(data['time'])
+        # Прежняя версия не отмечала доставку и не удаляла сработавшие напоминания:
+        # запись без delivered считается доставленной, если ее время уже прошло
+        delivered = data['delivered'] if 'delivered' in data else time <= datetime.now(utc)
+        return cls(data['id'], data['user_id'], time, data['text'], delivered, data.get('rule'))
+
+    def to_dict(self):
+        data = {"id": self.id, "time": self.time.isoformat(), "text": self.text, "user_id": self.user_id, "delivered": self.delivered}
+        if self.rule:
+            data["rule"] = self.rule
+        return data
+
+    def with_time(self, time):
+        # Время входит в ключ сортировки индекса, поэтому вместо изменения создается новая запись
+        return Reminder(self.id, self.user_id, time, self.text, self.delivered, self.rule)
+
+    def sort_key(self):
+        return (self.time, self.id)
+
+
+class ReminderIndex:
+    """Напоминания в памяти: поиск по id за O(1) и списки, отсортированные по времени."""
+
+    def __init__(self):
+        self._by_id = {}
+        self._by_user = {}  # user_id -> [Reminder], отсортирован по sort_key
+        self._by_time = []  # все напоминания, отсортированы по sort_key
+        self._lock = threading.Lock()
+
+    def add(self, reminder):
+        with self._lock:
+            self._insert(reminder)
+
+    def replace_user(self, user_id, items):
+        """Заменяет напоминания пользователя свежими из хранилища."""
+        with self._lock:
+            for reminder in list(self._by_user.get(str(user_id), ())):
+                del self._by_id[reminder.id]
+                self._unlink(reminder)
+            for reminder in items:
+                self._insert(reminder)
+
+    def _insert(self, reminder):
+        old = self._by_id.get(reminder.id)
+        if old is not None:
+            self._unlink(old)
+        self._by_id[reminder.id] = reminder
+        bisect.insort(self._by_user.setdefault(reminder.user_id, []), reminder, key=Reminder.sort_key)
+        bisect.insort(self._by_time, reminder, key=Reminder.sort_key)
+
+    def remove(self, reminder_id):
+        with self._lock:
+            reminder = self._by_id.pop(reminder_id, None)
+            if reminder is not None:
+                self._unlink(reminder)
+            return reminder
+
+    def _unlink(self, reminder):
+        user_reminders = self._by_user[reminder.user_id]
+        del user_reminders[bisect.bisect_left(user_reminders, reminder.sort_key(), key=Reminder.sort_key)]
+        if not user_reminders:
+            del self._by_user[reminder.user_id]
+        del self._by_time[bisect.bisect_left(self._by_time, reminder.sort_key(), key=Reminder.sort_key)]
+
+    def get(self, reminder_id):
+        return self._by_id.get(reminder_id)
+
+    def between(self, start, end):
+        """Напоминания со временем в полуинтервале (start, end], по возрастанию времени."""
+        with self._lock:
+            lo = bisect.bisect_right(self._by_time, start, key=lambda rem: rem.time)
+            hi = bisect.bisect_right(self._by_time, end, key=lambda rem: rem.time)
+            return self._by_time[lo:hi]
+
+    def before(self, end):
+        """Напоминания со временем не позже end."""
+        with self._lock:
+            return self._by_time[:bisect.bisect_right(self._by_time, end, key=lambda rem: rem.time)]
+
+    def for_user(self, user_id):
+        """Копия списка напоминаний пользователя, уже отсортированного по времени."""
+        with self._lock:
+            return list(self._by_user.get(str(user_id), ()))
+
+    def load(self, items):
+        with self._lock:
+            self._by_id = {rem.id: rem for rem in items}
+            self._by_user = {}
+            for rem in self._by_id.values():
+                self._by_user.setdefault(rem.user_id, []).append(rem)
+            for user_reminders in self._by_user.values():
+                user_reminders.sort(key=Reminder.sort_key)
+            self._by_time = sorted(self._by_id.values(), key=Reminder.sort_key)
+
+    def to_dict(self):
+        with self._lock:
+            return {user_id: [rem.to_dict() for rem in user_reminders] for user_id, user_reminders in self._by_user.items()}
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._by_id.values()))
+
+    def __len__(self):
+        return len(self._by_id)
+
+
+reminders = ReminderIndex()
+
 def save_data(data, filename):
-    """Универсальная функция для сохранения данных в JSON."""
+    """Универсальная функция для сохранения данных в JSON.
+
+    Пишет во временный файл и атомарно подменяет им старый, чтобы падение
+    посреди записи не оставило испорченный файл.
+    """
+    tmp_filename = f"{filename}.tmp"
     try:
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=4, default=str)
+        with metrics.timer("bot_storage_write_seconds", backend="json", op=os.path.basename(filename)):
+            payload = json.dumps(data, ensure_ascii=False, default=str).encode("utf-8")
+            with open(tmp_filename, "wb") as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_filename, filename)
+        metrics.inc("bot_storage_bytes_written_total", len(payload), file=os.path.basename(filename))
     except Exception as e:
         logger.error(f"Ошибка при сохранении файла {filename}: {e}")
 
@@ -64,49 +404,517 @@ def load_data(filename, default_value):
         logger.error(f"Ошибка декодирования JSON в файле {filename}. Будет использовано значение по умолчанию.")
         return default_value
 
+
+class JsonStorage:
+    """Хранилище в двух JSON-файлах: каждое изменение перезаписывает файл целиком.
+
+    Сериализует глобальные reminders и user_settings, поэтому вызывается
+    уже после изменения данных в памяти.
+    """
+
+    def __init__(self, reminders_file, settings_file, cities_file):
+        self.reminders_file = reminders_file
+        self.settings_file = settings_file
+        self.cities_file = cities_file
+        self._lock = threading.Lock()
+        self._claimed = set()  # id напоминаний, отданных в отправку, но еще не доставленных
+
+    def load_reminders(self):
+        data = load_data(self.reminders_file, {})
+        return [Reminder.from_dict(rem) for user_reminders in data.values() for rem in user_reminders]
+
+    def load_settings(self):
+        return load_data(self.settings_file, {})
+
+    def load_cities(self):
+        return load_data(self.cities_file, {})
+
+    def save_city(self, query, entry):
+        with self._lock:
+            save_data(city_resolver.to_dict(), self.cities_file)
+
+    def save_reminder(self, reminder):
+        self._save_reminders()
+
+    def save_reminders(self, new_reminders):
+        self._save_reminders()
+
+    def delete_reminder(self, reminder_id):
+        self._save_reminders()
+
+    def delete_reminders(self, reminder_ids):
+        self._save_reminders()
+
+    def claim_reminders(self, reminder_ids):
+        # Один процесс: захват живет в памяти и пропадает при перезапуске вместе с очередью отправки
+        with self._lock:
+            claimed = []
+            for reminder_id in reminder_ids:
+                reminder = reminders.get(reminder_id)
+                if reminder is not None and not reminder.delivered and reminder_id not in self._claimed:
+                    self._claimed.add(reminder_id)
+                    claimed.append(reminder_id)
+            return claimed
+
+    def release_reminders(self, reminder_ids):
+        with self._lock:
+            self._claimed.difference_update(reminder_ids)
+
+    def mark_delivered(self, reminder_ids):
+        self.release_reminders(reminder_ids)
+        self._save_reminders()
+
+    def advance_reminder(self, reminder_id, old_time, new_time):
+        reminder = reminders.get(reminder_id)
+        if reminder is None or reminder.time != old_time:
+            return False
+        reminders.add(reminder.with_time(new_time))
+        self._save_reminders()
+        return True
+
+    def get_meta(self, key):
+        # Служебные значения в JSON-режиме не сохраняются: при старте они вычисляются заново
+        return None
+
+    def set_meta(self, key, value):
+        pass
+
+    def save_settings(self, user_id, settings):
+        with self._lock:
+            save_data(user_settings, self.settings_file)
+
+    def _save_reminders(self):
+        with self._lock:
+            save_data(reminders.to_dict(), self.reminders_file)
+
+
+class SqliteStorage:
+    """Хранилище в SQLite (WAL): построчные upsert/delete вместо перезаписи файлов."""
+
+    # Каждый элемент — миграция схемы; номер применённой хранится в PRAGMA user_version
+    SCHEMA_MIGRATIONS = [
+        """
+        CREATE TABLE reminders (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            time TEXT NOT NULL,
+            text TEXT NOT NULL
+        );
+        CREATE INDEX idx_reminders_user ON reminders (user_id);
+        CREATE INDEX idx_reminders_time ON reminders (time);
+        CREATE TABLE user_settings (
+            user_id TEXT PRIMARY KEY,
+            city TEXT NOT NULL,
+            notification_time TEXT NOT NULL,
+            notifications_on INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        """,
+        """
+        ALTER TABLE reminders ADD COLUMN delivered INTEGER NOT NULL DEFAULT 0;
+        """,
+        """
+        CREATE TABLE cities (
+            query TEXT PRIMARY KEY,
+            city_id INTEGER,
+            name TEXT,
+            lat REAL,
+            lon REAL,
+            expires_at REAL
+        );
+        """,
+        """
+        CREATE INDEX idx_user_settings_time ON user_settings (notification_time);
+        CREATE TABLE leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE TABLE next_steps (
+            chat_id TEXT PRIMARY KEY,
+            handlers BLOB NOT NULL
+        );
+        CREATE TABLE processed_updates (
+            update_id INTEGER PRIMARY KEY,
+            received_at REAL NOT NULL
+        );
+        """,
+        """
+        ALTER TABLE reminders ADD COLUMN rule TEXT;
+        """,
+        """
+        ALTER TABLE reminders ADD COLUMN claimed_by TEXT;
+        ALTER TABLE reminders ADD COLUMN claimed_at REAL;
+        """,
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._opened_at = time()
+        self._migrate_schema()
+
+    @contextmanager
+    def _write(self, op):
+        """Транзакция записи под общей блокировкой, с замером длительности."""
+        with metrics.timer("bot_storage_write_seconds", backend="sqlite", op=op), self._lock, self._conn:
+            yield
+
+    def _migrate_schema(self):
+        with self._lock:
+            # BEGIN IMMEDIATE берет блокировку записи до чтения версии: экземпляр, стартующий
+            # одновременно на той же базе, дождется конца миграции и не станет повторять ALTER TABLE
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+                for number, script in enumerate(self.SCHEMA_MIGRATIONS[version:], start=version + 1):
+                    for statement in self._statements(script):
+                        self._conn.execute(statement)
+                    self._conn.execute(f"PRAGMA user_version = {number}")
+                    logger.info(f"Схема базы {self.path} обновлена до версии {number}.")
+            except BaseException:
+                self._conn.rollback()
+                raise
+            self._conn.commit()
+
+    @staticmethod
+    def _statements(script):
+        """Делит скрипт миграции на отдельные операторы (executescript закоммитил бы транзакцию)."""
+        statement = ""
+        for line in script.splitlines(keepends=True):
+            statement += line
+            if sqlite3.complete_statement(statement):
+                yield statement
+                statement = ""
+
+    def migrate_from_json(self, reminders_file, settings_file):
+        """Однократно переносит данные из JSON-файлов прежней версии бота."""
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+                return
+        old_reminders = load_data(reminders_file, {})
+        old_settings = load_data(settings_file, {})
+        with self._lock, self._conn:
+            # Отметка ставится первой в той же транзакции: из двух одновременно стартовавших
+            # экземпляров данные переносит только тот, чья вставка прошла
+            marked = self._conn.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES ('json_migrated', ?)", (datetime.now(utc).isoformat(),)
+            )
+            if not marked.rowcount:
+                return
+            # Через from_dict: сработавшие при старой версии записи переносятся уже доставленными
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO reminders (id, user_id, time, text, delivered, rule) VALUES (?, ?, ?, ?, ?, ?)",
+                [(rem.id, rem.user_id, rem.time.isoformat(), rem.text, int(rem.delivered), rem.rule)
+                 for rem in (Reminder.from_dict(data) for user_reminders in old_reminders.values() for data in user_reminders)]
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO user_settings (user_id, city, notification_time, notifications_on) VALUES (?, ?, ?, ?)",
+                [self._settings_row(user_id, settings) for user_id, settings in old_settings.items()]
+            )
+        logger.info(f"Перенесено из JSON: напоминаний у {len(old_reminders)} пользователей, настроек {len(old_settings)}.")
+
+    @staticmethod
+    def _settings_row(user_id, settings):
+        return (
+            str(user_id),
+            settings.get('city', 'Москва'),
+            settings.get('notification_time', '07:30'),
+            int(bool(settings.get('notifications_on', False)))
+        )
+
+    def _query_reminders(self, where="", params=()):
+        with self._lock:
+            rows = self._conn.execute(f"SELECT id, user_id, time, text, delivered, rule FROM reminders {where}", params).fetchall()
+        return [
+            Reminder(reminder_id, user_id, datetime.fromisoformat(time), text, bool(delivered), rule)
+            for reminder_id, user_id, time, text, delivered, rule in rows
+        ]
+
+    def load_reminders(self):
+        return self._query_reminders()
+
+    def load_reminder(self, reminder_id):
+        found = self._query_reminders("WHERE id = ?", (reminder_id,))
+        return found[0] if found else None
+
+    def load_user_reminders(self, user_id):
+        return self._query_reminders("WHERE user_id = ?", (str(user_id),))
+
+    def load_reminders_between(self, start, end):
+        """Напоминания в (start, end] по возрастанию времени; start=None — без нижней границы."""
+        # Время хранится в ISO-формате UTC, поэтому строки сравниваются в хронологическом порядке
+        if start is None:
+            return self._query_reminders("WHERE time <= ? ORDER BY time, id", (end.isoformat(),))
+        return self._query_reminders("WHERE time > ? AND time <= ? ORDER BY time, id", (start.isoformat(), end.isoformat()))
+
+    def load_settings(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT user_id, city, notification_time, notifications_on FROM user_settings").fetchall()
+        return {
+            user_id: {"city": city, "notification_time": notification_time, "notifications_on": bool(notifications_on)}
+            for user_id, city, notification_time, notifications_on in rows
+        }
+
+    def load_user_settings(self, user_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT city, notification_time, notifications_on FROM user_settings WHERE user_id = ?", (str(user_id),)
+            ).fetchone()
+        if row is None:
+            return None
+        city, notification_time, notifications_on = row
+        return {"city": city, "notification_time": notification_time, "notifications_on": bool(notifications_on)}
+
+    def load_weather_subscribers(self, time_str):
+        """[(user_id, city)] подписчиков с временем уведомления time_str."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT user_id, city FROM user_settings WHERE notification_time = ? AND notifications_on = 1", (time_str,)
+            ).fetchall()
+
+    def save_reminder(self, reminder):
+        self.save_reminders([reminder])
+
+    def save_reminders(self, new_reminders):
+        with self._write("save_reminders"):
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO reminders (id, user_id, time, text, delivered, rule) VALUES (?, ?, ?, ?, ?, ?)",
+                [(rem.id, rem.user_id, rem.time.isoformat(), rem.text, int(rem.delivered), rem.rule) for rem in new_reminders]
+            )
+
+    def delete_reminder(self, reminder_id):
+        self.delete_reminders([reminder_id])
+
+    def delete_reminders(self, reminder_ids):
+        with self._write("delete_reminders"):
+            self._conn.executemany("DELETE FROM reminders WHERE id = ?", [(reminder_id,) for reminder_id in reminder_ids])
+
+    def claim_reminders(self, reminder_ids):
+        """Атомарно захватывает недоставленные напоминания; возвращает захваченные id.
+
+        Напоминание достается одному отправителю, даже если его задачу успели
+        запустить два экземпляра. Захват — аренда, а не отметка доставки
+        (ее ставит mark_delivered после ответа Telegram): чужой захват снимается,
+        когда его держатель теряет аренду ведущего, свой — после перезапуска
+        процесса. Так напоминание из очереди отправки упавшего экземпляра
+        дошлет следующий ведущий.
+        """
+        now = time()
+        with self._write("claim_reminders"):
+            return [
+                reminder_id for reminder_id in reminder_ids
+                if self._conn.execute(
+                    "UPDATE reminders SET claimed_by = ?, claimed_at = ? WHERE id = ? AND delivered = 0 AND ("
+                    "claimed_by IS NULL "
+                    "OR (claimed_by = ? AND claimed_at < ?) "
+                    "OR (claimed_by != ? AND claimed_by NOT IN (SELECT holder FROM leases WHERE expires_at >= ?)))",
+                    (INSTANCE_ID, now, reminder_id, INSTANCE_ID, self._opened_at, INSTANCE_ID, now)
+                ).rowcount
+            ]
+
+    def release_reminders(self, reminder_ids):
+        """Снимает свой захват с напоминаний, которые так и не удалось отправить."""
+        with self._write("release_reminders"):
+            self._conn.executemany(
+                "UPDATE reminders SET claimed_by = NULL, claimed_at = NULL WHERE id = ? AND claimed_by = ? AND delivered = 0",
+                [(reminder_id, INSTANCE_ID) for reminder_id in reminder_ids]
+            )
+
+    def mark_delivered(self, reminder_ids):
+        with self._write("mark_delivered"):
+            self._conn.executemany(
+                "UPDATE reminders SET delivered = 1, claimed_by = NULL, claimed_at = NULL WHERE id = ?",
+                [(reminder_id,) for reminder_id in reminder_ids]
+            )
+
+    def advance_reminder(self, reminder_id, old_time, new_time):
+        """Переносит повторяющееся напоминание на new_time, если оно все еще стоит на old_time.
+
+        Аналог claim_reminders для повторов: следующее срабатывание
+        назначит ровно один экземпляр.
+        """
+        with self._write("advance_reminder"):
+            return self._conn.execute(
+                "UPDATE reminders SET time = ? WHERE id = ? AND time = ?", (new_time.isoformat(), reminder_id, old_time.isoformat())
+            ).rowcount == 1
+
+    def get_meta(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self._write("set_meta"):
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def save_settings(self, user_id, settings):
+        with self._write("save_settings"):
+            self._conn.execute(
+                "INSERT OR REPLACE INTO user_settings (user_id, city, notification_time, notifications_on) VALUES (?, ?, ?, ?)",
+                self._settings_row(user_id, settings)
+            )
+
+    def load_cities(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT query, city_id, name, lat, lon, expires_at FROM cities").fetchall()
+        return {
+            query: {"id": city_id, "name": name, "lat": lat, "lon": lon, "expires_at": expires_at}
+            for query, city_id, name, lat, lon, expires_at in rows
+        }
+
+    def save_city(self, query, entry):
+        with self._write("save_city"):
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cities (query, city_id, name, lat, lon, expires_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (query, entry['id'], entry['name'], entry['lat'], entry['lon'], entry['expires_at'])
+            )
+
+    def acquire_lease(self, name, holder, ttl):
+        """Захватывает свободную (или продлевает свою) аренду. True, если она у holder."""
+        now = time()
+        with self._write("acquire_lease"):
+            self._conn.execute(
+                "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+                "WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+                (name, holder, now + ttl, now)
+            )
+            return self._conn.execute("SELECT holder FROM leases WHERE name = ?", (name,)).fetchone()[0] == holder
+
+    def remember_update(self, update_id):
+        """Отмечает апдейт как принятый. False, если его уже принял другой экземпляр."""
+        with self._write("remember_update"):
+            return self._conn.execute(
+                "INSERT OR IGNORE INTO processed_updates (update_id, received_at) VALUES (?, ?)", (update_id, time())
+            ).rowcount == 1
+
+    def forget_update(self, update_id):
+        with self._write("forget_update"):
+            self._conn.execute("DELETE FROM processed_updates WHERE update_id = ?", (update_id,))
+
+    def prune_updates(self, before):
+        with self._write("prune_updates"):
+            return self._conn.execute("DELETE FROM processed_updates WHERE received_at < ?", (before,)).rowcount
+
+    def append_next_step(self, chat_id, handler):
+        with self._write("next_step"):
+            row = self._conn.execute("SELECT handlers FROM next_steps WHERE chat_id = ?", (str(chat_id),)).fetchone()
+            handlers = pickle.loads(row[0]) if row else []
+            handlers.append(handler)
+            self._conn.execute("INSERT OR REPLACE INTO next_steps (chat_id, handlers) VALUES (?, ?)", (str(chat_id), pickle.dumps(handlers)))
+
+    def pop_next_steps(self, chat_id):
+        with self._write("next_step"):
+            row = self._conn.execute("DELETE FROM next_steps WHERE chat_id = ? RETURNING handlers", (str(chat_id),)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def clear_next_steps(self, chat_id):
+        with self._write("next_step"):
+            self._conn.execute("DELETE FROM next_steps WHERE chat_id = ?", (str(chat_id),))
+
+
+class SqliteHandlerBackend(HandlerBackend):
+    """Обработчики следующего шага в общей базе: диалог можно продолжить на любом экземпляре.
+
+    Как и RedisHandlerBackend из telebot, хранит pickle списка обработчиков,
+    поэтому регистрировать можно только функции уровня модуля.
+    """
+
+    def __init__(self, storage):
+        super().__init__()
+        self.storage = storage
+
+    def register_handler(self, handler_group_id, handler):
+        self.storage.append_next_step(handler_group_id, handler)
+
+    def clear_handlers(self, handler_group_id):
+        self.storage.clear_next_steps(handler_group_id)
+
+    def get_handlers(self, handler_group_id):
+        return self.storage.pop_next_steps(handler_group_id)
+
+
+def create_storage():
+    if STORAGE_BACKEND == "json":
+        if CLUSTER_MODE:
+            raise RuntimeError("CLUSTER_MODE работает только с STORAGE_BACKEND=sqlite.")
+        return JsonStorage(REMINDERS_FILE, SETTINGS_FILE, CITIES_FILE)
+    return SqliteStorage(DB_PATH)
+
+storage = create_storage()
+if CLUSTER_MODE:
+    bot.next_step_backend = SqliteHandlerBackend(storage)
+
 # === 3. Клавиатуры ===
+# Клавиатуры не зависят от пользователя (кроме кнопки включения уведомлений), поэтому
+# собираются и сериализуются в JSON один раз при импорте. telebot передает строку
+# reply_markup в API как есть, без повторной сериализации.
 
-def get_main_menu_keyboard():
+def _build_main_menu_keyboard():
     keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
     keyboard.add(
         types.KeyboardButton("📋 Мои напоминания"),
         types.KeyboardButton("➕ Добавить напоминание"),
         types.KeyboardButton("🌤 Погода")
     )
-    return keyboard
+    return keyboard.to_json()
 
-def get_weather_menu_keyboard():
+def _build_weather_menu_keyboard():
     keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
     keyboard.add(types.KeyboardButton("🌦 Погода сейчас"))
     keyboard.add(types.KeyboardButton("⚙️ Настройки погоды"))
     keyboard.add(types.KeyboardButton("↩️ Назад в меню"))
-    return keyboard
+    return keyboard.to_json()
 
-def get_weather_settings_keyboard(user_id):
-    settings = user_settings.get(str(user_id), {})
-    notifications_on = settings.get('notifications_on', False)
+def _build_weather_settings_keyboard(notifications_on):
     status_text = "❌ Выключить уведомления" if notifications_on else "✅ Включить уведомления"
-
     keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
     keyboard.add(types.KeyboardButton("🏙 Изменить город"))
     keyboard.add(types.KeyboardButton("⏰ Изменить время"))
     keyboard.add(types.KeyboardButton(status_text))
     keyboard.add(types.KeyboardButton("↩️ Назад в меню погоды"))
-    return keyboard
+    return keyboard.to_json()
 
-def get_back_to_menu_keyboard(weather=False):
+def _build_back_keyboard(text):
     keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    if weather:
-        keyboard.add(types.KeyboardButton("↩️ Назад в меню погоды"))
-    else:
-        keyboard.add(types.KeyboardButton("↩️ Назад в меню"))
-    return keyboard
-    
-def create_reminder_inline_keyboard(reminder_id):
+    keyboard.add(types.KeyboardButton(text))
+    return keyboard.to_json()
+
+MAIN_MENU_KEYBOARD = _build_main_menu_keyboard()
+WEATHER_MENU_KEYBOARD = _build_weather_menu_keyboard()
+WEATHER_SETTINGS_KEYBOARDS = {flag: _build_weather_settings_keyboard(flag) for flag in (False, True)}
+BACK_TO_MENU_KEYBOARD = _build_back_keyboard("↩️ Назад в меню")
+BACK_TO_WEATHER_MENU_KEYBOARD = _build_back_keyboard("↩️ Назад в меню погоды")
+REMOVE_KEYBOARD = types.ReplyKeyboardRemove().to_json()
+
+def get_main_menu_keyboard():
+    return MAIN_MENU_KEYBOARD
+
+def get_weather_menu_keyboard():
+    return WEATHER_MENU_KEYBOARD
+
+def get_weather_settings_keyboard(user_id):
+    settings = user_settings.get(str(user_id), {})
+    return WEATHER_SETTINGS_KEYBOARDS[bool(settings.get('notifications_on', False))]
+
+def get_back_to_menu_keyboard(weather=False):
+    return BACK_TO_WEATHER_MENU_KEYBOARD if weather else BACK_TO_MENU_KEYBOARD
+
+
+def create_reminder_inline_keyboard(reminder):
+    # У повтора в кнопки входит срабатывание (как в id задачи): «Выполнено» отмечает именно его
+    key = reminder_job_id(reminder)
     keyboard = types.InlineKeyboardMarkup()
     keyboard.row(
-        types.InlineKeyboardButton("✅ Выполнено", callback_data=f"rem_done_{reminder_id}"),
-        types.InlineKeyboardButton("🗑️ Удалить", callback_data=f"rem_delete_{reminder_id}")
+        types.InlineKeyboardButton("✅ Выполнено", callback_data=f"rem_done_{key}"),
+        types.InlineKeyboardButton("🗑️ Удалить", callback_data=f"rem_delete_{key}")
     )
     return keyboard
 
@@ -114,8 +922,6 @@ def create_reminder_inline_keyboard(reminder_id):
 
 def ensure_user_data_exists(user_id):
     user_id_str = str(user_id)
-    if user_id_str not in reminders:
-        reminders[user_id_str] = []
     if user_id_str not in user_settings:
         user_settings[user_id_str] = {
             "city": "Москва",
@@ -123,21 +929,175 @@ def ensure_user_data_exists(user_id):
             "notifications_on": False
         }
 
-def parse_reminder_text(text):
+def refresh_user_state(user_id):
+    """В режиме кластера перечитывает данные пользователя из общей базы перед обработкой апдейта."""
+    user_id_str = str(user_id)
+    settings = storage.load_user_settings(user_id_str)
+    if settings is None:
+        ensure_user_data_exists(user_id_str)
+    else:
+        user_settings[user_id_str] = settings
+    reminders.replace_user(user_id_str, storage.load_user_reminders(user_id_str))
+
+FULL_REMINDER_RE = re.compile(r'^(\d{1,2})[.,](\d{1,2})\s+(\d{1,2})[.,:](\d{2})\s+(.+)')
+TIME_REMINDER_RE = re.compile(r'^(\d{1,2})[.,:](\d{2})\s+(.+)')
+WEEKDAY_NAMES = ["пн", "вт", "ср", "чт", "пт", "сб", "вс"]
+_WEEKDAY_RE = "|".join(WEEKDAY_NAMES)
+RECURRING_REMINDER_RE = re.compile(
+    r'^(?:(?P<daily>каждый день|ежедневно)'
+    r'|(?P<weekdays>по будням)'
+    rf'|по (?P<days>(?:{_WEEKDAY_RE})(?:\s*,\s*(?:{_WEEKDAY_RE}))*)'
+    r'|(?:каждый месяц|ежемесячно) (?P<monthday>\d{1,2})(?:-?го)?'
+    r'|каждые (?P<hours>\d{1,2}) ?ч(?:аса|асов)?\.?)'
+    r'\s+(?:(?P<hour>\d{1,2})[.,:](?P<minute>\d{2})\s+)?(?P<event>.+)$',
+    re.IGNORECASE
+)
+
+# --- Правила повтора ---
+# Правило хранится строкой: "daily", "weekdays", "weekly:0,2,4" (дни недели, пн=0),
+# "hours:N" (каждые N часов) или "monthly:D" (D-го числа, в коротких месяцах — последнего).
+# Время суток берется из текущего срабатывания напоминания (по Москве).
+
+def _rule_days(kind, arg):
+    if kind == 'weekdays':
+        return {0, 1, 2, 3, 4}
+    if kind == 'weekly':
+        return {int(day) for day in arg.split(',')}
+    return set(range(7))
+
+def _monthly_date(year, month, day):
+    return min(day, calendar.monthrange(year, month)[1])
+
+def next_occurrence(rule, last, now=None):
+    """Первое срабатывание правила строго позже last и now (aware datetime в UTC)."""
+    now = max(last, now or last)
+    kind, _, arg = rule.partition(':')
+    if kind == 'hours':
+        step = timedelta(hours=int(arg))
+        return last + step * ((now - last) // step + 1)
+    last_moscow = last.astimezone(moscow_tz)
+    hour, minute = last_moscow.hour, last_moscow.minute
+    if kind == 'monthly':
+        year, month = last_moscow.year, last_moscow.month
+        while True:
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+            candidate = moscow_tz.localize(datetime(year, month, _monthly_date(year, month, int(arg)), hour, minute))
+            if candidate > now:
+                return candidate.astimezone(utc)
+    days = _rule_days(kind, arg)
+    # После долгого простоя не перебираем дни с момента last, а начинаем со вчерашнего
+    date = max(last_moscow.date(), now.astimezone(moscow_tz).date() - timedelta(days=1))
+    while True:
+        date += timedelta(days=1)
+        if date.weekday() in days:
+            candidate = moscow_tz.localize(datetime(date.year, date.month, date.day, hour, minute))
+            if candidate > now:
+                return candidate.astimezone(utc)
+
+def first_occurrence(rule, hour, minute, now):
+    """Первое срабатывание нового повторяющегося напоминания; now — aware datetime по Москве."""
+    kind, _, arg = rule.partition(':')
+    if kind == 'monthly':
+        candidate = moscow_tz.localize(datetime(now.year, now.month, _monthly_date(now.year, now.month, int(arg)), hour, minute))
+        matches = True
+    else:
+        candidate = moscow_tz.localize(datetime(now.year, now.month, now.day, hour, minute))
+        matches = kind == 'hours' or candidate.weekday() in _rule_days(kind, arg)
+    if matches and candidate > now:
+        return candidate
+    return next_occurrence(rule, candidate.astimezone(utc), now.astimezone(utc)).astimezone(moscow_tz)
+
+def describe_rule(rule):
+    kind, _, arg = rule.partition(':')
+    if kind == 'daily':
+        return "каждый день"
+    if kind == 'weekdays':
+        return "по будням"
+    if kind == 'weekly':
+        return "по " + ", ".join(WEEKDAY_NAMES[int(day)] for day in arg.split(','))
+    if kind == 'hours':
+        return f"каждые {arg} ч"
+    return f"каждый месяц {arg}-го числа"
+
+def parse_recurring_text(text, now):
+    """Разбирает «по будням 09:00 Планерка». Возвращает (dt_moscow, событие, правило) или None."""
+    match = RECURRING_REMINDER_RE.match(text)
+    if not match:
+        return None
+    groups = match.groupdict()
+    if groups['hours']:
+        hours = int(groups['hours'])
+        if not 1 <= hours <= 24:
+            return None
+        rule = f"hours:{hours}"
+    elif groups['hour'] is None:
+        return None  # для повторов по дням время обязательно
+    elif groups['daily']:
+        rule = "daily"
+    elif groups['weekdays']:
+        rule = "weekdays"
+    elif groups['days']:
+        days = sorted({WEEKDAY_NAMES.index(day.strip().lower()) for day in groups['days'].split(',')})
+        rule = "weekly:" + ",".join(map(str, days))
+    else:
+        if not 1 <= int(groups['monthday']) <= 31:
+            return None
+        rule = f"monthly:{int(groups['monthday'])}"
+    if groups['hour'] is None:
+        # «каждые 3 ч Попить воды» — первый раз через N часов
+        dt_moscow = now.replace(second=0, microsecond=0) + timedelta(hours=hours)
+    else:
+        dt_moscow = first_occurrence(rule, int(groups['hour']), int(groups['minute']), now)
+    return dt_moscow, groups['event'], rule
+
+def parse_reminder_text(text, now=None):
+    """Возвращает (dt_moscow, событие, правило повтора или None); при ошибке — (None, None, None)."""
+    now = now or datetime.now(moscow_tz)
+    text = text.strip()
+    try:
+        recurring = parse_recurring_text(text, now)
+        if recurring:
+            return recurring
+        full_match = FULL_REMINDER_RE.match(text)
+        if full_match:
+            day, month, hour, minute, event = full_match.groups()
+            dt_moscow = moscow_tz.localize(datetime(now.year, int(month), int(day), int(hour), int(minute)))
+            return dt_moscow, event, None
+        time_match = TIME_REMINDER_RE.match(text)
+        if time_match:
+            hour, minute, event = time_match.groups()
+            dt_moscow = moscow_tz.localize(datetime(now.year, now.month, now.day, int(hour), int(minute)))
+            if dt_moscow < now:
+                dt_moscow += timedelta(days=1)
+            return dt_moscow, event, None
+    except ValueError:
+        # Несуществующая дата или время, например 31.02 или 25:00
+        pass
+    return None, None, None
+
+def parse_reminder_lines(lines):
+    """Разбирает много строк за один проход. Возвращает ([(dt_moscow, событие, правило)], [нераспознанные строки])."""
     now = datetime.now(moscow_tz)
-    full_match = re.match(r'^(\d{1,2})[.,](\d{1,2})\s+(\d{1,2})[.,:](\d{2})\s+(.+)', text.strip())
-    if full_match:
-        day, month, hour, minute, event = full_match.groups()
-        dt_moscow = moscow_tz.localize(datetime(now.year, int(month), int(day), int(hour), int(minute)))
-        return dt_moscow, event
-    time_match = re.match(r'^(\d{1,2})[.,:](\d{2})\s+(.+)', text.strip())
-    if time_match:
-        hour, minute, event = time_match.groups()
-        dt_moscow = moscow_tz.localize(datetime(now.year, now.month, now.day, int(hour), int(minute)))
-        if dt_moscow < now:
-            dt_moscow += timedelta(days=1)
-        return dt_moscow, event
-    return None, None
+    parsed, rejected = [], []
+    for line in lines:
+        reminder_dt_moscow, event, rule = parse_reminder_text(line, now)
+        if reminder_dt_moscow and event:
+            parsed.append((reminder_dt_moscow, event, rule))
+        else:
+            rejected.append(line)
+    return parsed, rejected
+
+def read_import_lines(file_name, content):
+    """Достает строки напоминаний из загруженного .txt или .csv файла."""
+    text = content.decode("utf-8-sig", errors="replace")
+    if file_name.lower().endswith(".csv"):
+        try:
+            dialect = csv.Sniffer().sniff(text[:1024], delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        # Ячейки строки склеиваются: "03.08;08:45;Зарядка" -> "03.08 08:45 Зарядка"
+        return [" ".join(cell.strip() for cell in row if cell.strip()) for row in csv.reader(io.StringIO(text), dialect)]
+    return text.splitlines()
 
 def parse_time_input(text):
     match = re.match(r'^(\d{1,2})[.,:](\d{2})$', text.strip())
@@ -149,35 +1109,330 @@ def parse_time_input(text):
 
 # === 5. Логика погоды ===
 
-def get_and_format_24h_forecast(city):
-    """Получает и форматирует прогноз на 24 часа."""
-    url = f"https://api.openweathermap.org/data/2.5/forecast?q={city}&appid={WEATHER_API_KEY}&units=metric&lang=ru"
-    try:
-        response = requests.get(url, timeout=10)
+class TTLCache:
+    """Потокобезопасный LRU-кэш с временем жизни записей.
+
+    Параллельные промахи по одному ключу объединяются: загрузчик вызывается
+    один раз, остальные потоки ждут его результат (или его исключение).
+    """
+
+    def __init__(self, name, ttl, max_size):
+        self.name = name  # метка cache в метриках
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._inflight = {}  # key -> _Flight
+        self._lock = threading.Lock()
+
+    class _Flight:
+        __slots__ = ("event", "value", "error")
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.value = None
+            self.error = None
+
+    def get_or_load(self, key, loader):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > monotonic():
+                self._entries.move_to_end(key)
+                metrics.inc("bot_cache_requests_total", cache=self.name, result="hit")
+                return entry[1]
+            flight = self._inflight.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = self._inflight[key] = self._Flight()
+        metrics.inc("bot_cache_requests_total", cache=self.name, result="miss" if is_leader else "coalesced")
+
+        if not is_leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = loader()
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            self.set(key, flight.value)
+            return flight.value
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_stale(self, key):
+        """Значение из кэша, даже если его срок уже истек (для работы при недоступном сервисе)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[1] if entry is not None else None
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def create_http_session(pool_size):
+    """requests.Session с keep-alive и пулом соединений нужного размера."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Запрос не отправлен: предохранитель разомкнут после серии ошибок."""
+
+
+class CircuitBreaker:
+    """После threshold ошибок подряд размыкается на cooldown секунд, затем пропускает один пробный запрос."""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if monotonic() - self.opened_at < self.cooldown or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning(f"Сервис погоды недоступен: предохранитель разомкнут на {self.cooldown:.0f} с.")
+                self.opened_at = monotonic()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+
+class WeatherClient:
+    """Общий клиент OpenWeatherMap поверх пула соединений."""
+
+    def __init__(self, base_url, timeout, pool_size, max_retries, deadline):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.deadline = deadline
+        self.session = create_http_session(pool_size)
+        self.breaker = CircuitBreaker(WEATHER_BREAKER_THRESHOLD, WEATHER_BREAKER_COOLDOWN)
+
+    def get(self, path, params):
+        """GET с повторами при сетевых ошибках и 5xx. Ответы 4xx возвращаются вызывающему.
+
+        Вызов вместе с повторами укладывается в self.deadline секунд: обработчик
+        не должен ждать дольше, чем ждал бы один запрос без повторов.
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError("предохранитель сервиса погоды разомкнут")
+        params = dict(params, appid=WEATHER_API_KEY)
+        deadline = monotonic() + self.deadline
+        error = None
+        for attempt in range(self.max_retries + 1):
+            started = monotonic()
+            try:
+                response = self.session.get(self.base_url + path, params=params, timeout=min(self.timeout, deadline - started))
+            except requests.RequestException as e:
+                error = e
+            else:
+                if response.status_code < 500 and response.status_code != 429:
+                    self._record(started)
+                    self.breaker.record_success()
+                    return response
+                error = requests.exceptions.HTTPError(f"{response.status_code} от сервиса погоды", response=response)
+            self._record(started, failed=True)
+            if attempt < self.max_retries:
+                # Экспоненциальная задержка со случайным разбросом, чтобы повторы не шли волной
+                backoff = 0.5 * 2 ** attempt * random.uniform(0.5, 1.5)
+                # Повторяем, только если попытка с полным таймаутом успеет уложиться в бюджет
+                if monotonic() + backoff + self.timeout > deadline:
+                    break
+                sleep(backoff)
+        self.breaker.record_failure()
+        raise error
+
+    @staticmethod
+    def _record(started, failed=False):
+        metrics.observe("bot_weather_api_seconds", monotonic() - started, outcome="error" if failed else "ok")
+
+
+weather_client = WeatherClient(WEATHER_API_URL, WEATHER_TIMEOUT, WEATHER_POOL_SIZE, WEATHER_MAX_RETRIES, WEATHER_DEADLINE)
+
+
+class CityResolver:
+    """Постоянный кэш «название города -> id и координаты OpenWeatherMap».
+
+    Варианты написания одного города ("москва", "Москва ", "Moscow") после
+    первого разрешения дают один и тот же id, а прогноз запрашивается по id.
+    Неизвестные названия кэшируются на CITY_NEGATIVE_TTL секунд.
+    """
+
+    def __init__(self):
+        self._entries = {}  # нормализованный запрос -> {"id", "name", "lat", "lon", "expires_at"}
+        self._lock = threading.Lock()
+
+    def load(self, entries):
+        with self._lock:
+            self._entries = dict(entries)
+
+    def to_dict(self):
+        with self._lock:
+            return dict(self._entries)
+
+    def cached(self, city):
+        """Запись из кэша без обращения к сети (None, если города нет или срок истек)."""
+        with self._lock:
+            entry = self._entries.get(normalize_city(city))
+        if entry is None or (entry['expires_at'] is not None and entry['expires_at'] < time()):
+            return None
+        return entry
+
+    def resolve(self, city):
+        """Возвращает запись о городе или None, если город не существует.
+
+        Ошибки сервиса погоды пробрасываются и не кэшируются.
+        """
+        entry = self.cached(city)
+        if entry is None:
+            entry = self._fetch(city)
+            query = normalize_city(city)
+            with self._lock:
+                self._entries[query] = entry
+            storage.save_city(query, entry)
+        return entry if entry['id'] is not None else None
+
+    def _fetch(self, city):
+        response = weather_client.get("/data/2.5/weather", {"q": city, "lang": "ru"})
+        if response.status_code == 404:
+            return {"id": None, "name": None, "lat": None, "lon": None, "expires_at": time() + CITY_NEGATIVE_TTL}
         response.raise_for_status()
         data = response.json()
+        return {
+            "id": data['id'],
+            "name": data['name'],
+            "lat": data['coord']['lat'],
+            "lon": data['coord']['lon'],
+            "expires_at": None,
+        }
 
-        # Текущая погода
-        current = data['list'][0]
-        description = current['weather'][0]['description'].capitalize()
-        temp = round(current['main']['temp'])
-        
-        weather_text = (
-            f"📍 Погода в городе: *{city}*\n\n"
-            f"Сейчас: *{description}*, температура *{temp}°C*\n\n"
-            f"🗓️ *Прогноз на 24 часа:*\n"
-        )
-        
-        # Прогноз на 8 периодов (24 часа)
-        forecast_lines = []
-        for forecast in data['list'][:8]:
-            dt_moscow = datetime.fromtimestamp(forecast['dt']).astimezone(moscow_tz)
-            time_str = dt_moscow.strftime('%H:%M')
-            temp_str = f"{round(forecast['main']['temp'])}°C"
-            desc_str = forecast['weather'][0]['description']
-            forecast_lines.append(f"`{time_str}` - {temp_str}, {desc_str}")
-        
-        return weather_text + "\n".join(forecast_lines)
+    def __len__(self):
+        return len(self._entries)
+
+
+city_resolver = CityResolver()
+
+
+forecast_cache = TTLCache("forecast", FORECAST_CACHE_TTL, FORECAST_CACHE_SIZE)
+# Готовый текст по (город, время первого периода прогноза): рассылка и «Погода сейчас»
+# не форматируют заново прогноз, который уже показывали
+forecast_text_cache = TTLCache("forecast_text", FORECAST_CACHE_TTL, FORECAST_CACHE_SIZE)
+
+def normalize_city(city):
+    """Приводит название города к ключу кэша: "  москва " и "Москва" совпадают."""
+    return " ".join(city.split()).casefold()
+
+def fetch_forecast_data(query):
+    """Запрашивает сырой прогноз у OpenWeatherMap (без кэша); query — {"id": ...} или {"q": ...}."""
+    response = weather_client.get("/data/2.5/forecast", dict(query, units="metric", lang="ru"))
+    response.raise_for_status()
+    return response.json()
+
+def forecast_query(city):
+    """Ключ кэша и параметры запроса прогноза: по id города, если его удалось разрешить.
+
+    Возвращает None, если такого города нет.
+    """
+    try:
+        entry = city_resolver.resolve(city)
+        if entry is None:
+            return None
+    except requests.RequestException as e:
+        logger.warning(f"Не удалось разрешить город {city}: {e}")
+        entry = city_resolver.cached(city)
+    if entry is not None:
+        return f"id:{entry['id']}", {"id": entry['id']}
+    return normalize_city(city), {"q": city}
+
+def format_24h_forecast(city, data):
+    # Текущая погода
+    current = data['list'][0]
+    description = current['weather'][0]['description'].capitalize()
+    temp = round(current['main']['temp'])
+
+    weather_text = (
+        f"📍 Погода в городе: *{city}*\n\n"
+        f"Сейчас: *{description}*, температура *{temp}°C*\n\n"
+        f"🗓️ *Прогноз на 24 часа:*\n"
+    )
+
+    # Прогноз на 8 периодов (24 часа)
+    forecast_lines = []
+    for forecast in data['list'][:8]:
+        dt_moscow = datetime.fromtimestamp(forecast['dt']).astimezone(moscow_tz)
+        time_str = dt_moscow.strftime('%H:%M')
+        temp_str = f"{round(forecast['main']['temp'])}°C"
+        desc_str = forecast['weather'][0]['description']
+        forecast_lines.append(f"`{time_str}` - {temp_str}, {desc_str}")
+
+    return weather_text + "\n".join(forecast_lines)
+
+def get_and_format_24h_forecast(city):
+    """Получает (через кэш) и форматирует прогноз на 24 часа."""
+    stale_note = ""
+    try:
+        resolved = forecast_query(city)
+        if resolved is None:
+            return f"❌ Город '{city}' не найден. Проверьте название в настройках."
+        cache_key, query = resolved
+        started = monotonic()
+        source = "cache"
+        def load():
+            nonlocal source
+            source = "upstream"
+            return fetch_forecast_data(query)
+        try:
+            data = forecast_cache.get_or_load(cache_key, load)
+        except requests.RequestException as e:
+            if isinstance(e, requests.exceptions.HTTPError) and e.response is not None and e.response.status_code < 500:
+                raise
+            # Сервис недоступен: отдаем последний сохраненный прогноз, если он есть
+            data = forecast_cache.get_stale(cache_key)
+            if data is None:
+                raise
+            source = "stale"
+            logger.warning(f"Сервис погоды недоступен ({e}), для {city} отдан устаревший прогноз.")
+            stale_note = "\n\n⚠️ _Сервис погоды недоступен, показан последний сохраненный прогноз._"
+        metrics.observe("bot_forecast_seconds", monotonic() - started, source=source)
+        text_key = (city, data['list'][0]['dt'], bool(stale_note))
+        return forecast_text_cache.get_or_load(text_key, lambda: format_24h_forecast(city, data) + stale_note)
 
     except requests.exceptions.HTTPError as e:
         if e.response.status_code == 404:
@@ -185,6 +1440,9 @@ def get_and_format_24h_forecast(city):
         else:
             logger.error(f"HTTP ошибка при получении погоды для {city}: {e}")
             return "🌦️ Не удалось связаться с сервисом погоды. Попробуйте позже."
+    except requests.RequestException as e:
+        logger.error(f"Сервис погоды недоступен для {city}: {e}")
+        return "🌦️ Не удалось связаться с сервисом погоды. Попробуйте позже."
     except Exception as e:
         logger.error(f"Общая ошибка при получении погоды для {city}: {e}")
         return "🌦️ Произошла непредвиденная ошибка при получении прогноза."
@@ -192,7 +1450,67 @@ def get_and_format_24h_forecast(city):
 
 # === 6. Обработчики команд и кнопок ===
 
+def timed_handler(handler):
+    """Замеряет время обработчика в метрике bot_handler_seconds."""
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        with metrics.timer("bot_handler_seconds", handler=handler.__name__):
+            return handler(*args, **kwargs)
+    return wrapper
+
+
+class TextRouter:
+    """Маршрутизация текстовых сообщений вместо цепочки message_handler(func=lambda ...).
+
+    Надписи кнопок находятся одним поиском в словаре; регулярные выражения
+    компилируются при регистрации и проверяются по порядку, только если
+    точного совпадения нет.
+    """
+
+    def __init__(self):
+        self._exact = {}  # текст -> обработчик
+        self._patterns = []  # [(скомпилированное выражение, обработчик)]
+
+    def exact(self, *labels):
+        def register(handler):
+            for label in labels:
+                if label in self._exact:
+                    raise ValueError(f"Надпись {label!r} уже обрабатывает {self._exact[label].__name__}")
+                self._exact[label] = handler
+            return handler
+        return register
+
+    def pattern(self, regex):
+        compiled = re.compile(regex)
+        def register(handler):
+            self._patterns.append((compiled, handler))
+            return handler
+        return register
+
+    def resolve(self, text):
+        """Обработчик для текста и способ совпадения ("exact"/"pattern"), либо (None, None)."""
+        handler = self._exact.get(text)
+        if handler is not None:
+            return handler, "exact"
+        for compiled, handler in self._patterns:
+            if compiled.search(text):
+                return handler, "pattern"
+        return None, None
+
+    def dispatch(self, message):
+        handler, match = self.resolve(message.text or "")
+        if handler is None:
+            return False
+        # Счетчик вызовов — метрика: она уже под блокировкой, а dispatch зовут несколько потоков
+        metrics.inc("bot_route_total", handler=handler.__name__, match=match)
+        handler(message)
+        return True
+
+
+router = TextRouter()
+
 @bot.message_handler(commands=['start'])
+@timed_handler
 def handle_start(message):
     user_id = message.from_user.id
     ensure_user_data_exists(user_id)
@@ -204,6 +1522,7 @@ def handle_start(message):
 
 # --- ИСПРАВЛЕННЫЙ БЛОК: ОТПРАВКА ИНСТРУКЦИИ ФАЙЛОМ ---
 @bot.message_handler(commands=['help'])
+@timed_handler
 def handle_help(message):
     """Отправляет пользователю инструкцию в виде .txt файла."""
     try:
@@ -223,83 +1542,153 @@ def handle_help(message):
         bot.send_message(message.chat.id, "Произошла ошибка при отправке файла с инструкцией.")
 # --- КОНЕЦ ИСПРАВЛЕННОГО БЛОКА ---
 
-@bot.message_handler(func=lambda message: message.text == "↩️ Назад в меню")
+@router.exact("↩️ Назад в меню")
+@timed_handler
 def handle_back_to_main_menu(message):
     bot.send_message(message.chat.id, "Главное меню:", reply_markup=get_main_menu_keyboard())
 
 # --- Блок Напоминаний ---
-@bot.message_handler(func=lambda message: message.text in ["📋 Мои напоминания", "➕ Добавить напоминание"])
+@router.exact("📋 Мои напоминания", "➕ Добавить напоминание")
+@timed_handler
 def handle_reminders_menu(message):
     user_id = str(message.from_user.id)
     ensure_user_data_exists(user_id)
     if message.text == "📋 Мои напоминания":
-        user_reminders = reminders.get(user_id, [])
-        if not user_reminders:
-            bot.send_message(message.chat.id, "У вас пока нет активных напоминаний.", reply_markup=get_main_menu_keyboard())
-            return
-        
-        sorted_reminders = sorted(user_reminders, key=lambda x: x['time'])
-        
+        sorted_reminders = reminders.for_user(user_id)  # индекс уже хранит их по времени
         if not sorted_reminders:
             bot.send_message(message.chat.id, "У вас пока нет активных напоминаний.", reply_markup=get_main_menu_keyboard())
             return
 
         bot.send_message(message.chat.id, "Ваши активные напоминания:", reply_markup=get_main_menu_keyboard())
+        # Записи списка идут через очередь отправки: при сотнях напоминаний синхронная отправка
+        # упирается в лимит на чат, а ответ Telegram здесь не нужен
         for rem in sorted_reminders:
-            dt_moscow = datetime.fromisoformat(rem['time']).astimezone(moscow_tz)
-            text = f"🗓️ *{dt_moscow.strftime('%d.%m в %H:%M')}*\n_{rem['text']}_"
-            bot.send_message(message.chat.id, text, parse_mode='Markdown', reply_markup=create_reminder_inline_keyboard(rem['id']))
+            dt_moscow = rem.time.astimezone(moscow_tz)
+            text = f"🗓️ *{dt_moscow.strftime('%d.%m в %H:%M')}*\n_{rem.text}_"
+            if rem.rule:
+                text += f"\n🔁 {describe_rule(rem.rule)}"
+            outbox.send(message.chat.id, text, priority=PRIORITY_REMINDER, parse_mode='Markdown', reply_markup=create_reminder_inline_keyboard(rem))
 
     elif message.text == "➕ Добавить напоминание":
-        msg = bot.send_message(message.chat.id, "Введите напоминание в формате:\n`ЧЧ:ММ событие`\nили\n`ДД.ММ ЧЧ:ММ событие`", parse_mode='Markdown', reply_markup=get_back_to_menu_keyboard())
+        msg = bot.send_message(message.chat.id, "Введите напоминание в формате:\n`ЧЧ:ММ событие`\nили\n`ДД.ММ ЧЧ:ММ событие`\n\nПовторяющееся: `каждый день 09:00 ...`, `по будням 09:00 ...`, `по пн,чт 19:00 ...`, `каждые 3 ч ...`, `каждый месяц 15 10:00 ...`\n\nМожно прислать сразу несколько строк или .txt/.csv файл.", parse_mode='Markdown', reply_markup=get_back_to_menu_keyboard())
         bot.register_next_step_handler(msg, process_new_reminder)
 
 
+@timed_handler
 def process_new_reminder(message):
     if message.text == "↩️ Назад в меню": return handle_back_to_main_menu(message)
     user_id = str(message.from_user.id)
     ensure_user_data_exists(user_id)
-    reminder_dt_moscow, event = parse_reminder_text(message.text)
+    if message.content_type == 'document':
+        return process_reminder_document(message)
+    lines = [line for line in (message.text or "").splitlines() if line.strip()]
+    if len(lines) > 1:
+        return import_reminders(message, lines)
+    reminder_dt_moscow, event, rule = parse_reminder_text(message.text or "")
     if not reminder_dt_moscow or not event:
         msg = bot.send_message(message.chat.id, "❌ Неверный формат. Попробуйте: `19:30 Ужин`", parse_mode='Markdown', reply_markup=get_back_to_menu_keyboard())
         bot.register_next_step_handler(msg, process_new_reminder)
         return
     reminder_dt_utc = reminder_dt_moscow.astimezone(utc)
     reminder_id = str(uuid.uuid4())
-    new_reminder = {"id": reminder_id, "time": reminder_dt_utc.isoformat(), "text": event, "user_id": user_id}
-    reminders[user_id].append(new_reminder)
-    save_data(reminders, 'reminders.json')
-    scheduler.add_job(send_reminder, trigger='date', run_date=reminder_dt_utc, args=[user_id, new_reminder], id=reminder_id)
-    bot.send_message(message.chat.id, f"✅ Напоминание установлено на *{reminder_dt_moscow.strftime('%d.%m.%Y в %H:%M')}*", parse_mode='Markdown', reply_markup=get_main_menu_keyboard())
+    new_reminder = Reminder(reminder_id, user_id, reminder_dt_utc, event, rule=rule)
+    reminders.add(new_reminder)
+    storage.save_reminder(new_reminder)
+    schedule_reminder_jobs([new_reminder])
+    if rule:
+        text = f"✅ Повторяющееся напоминание ({describe_rule(rule)}) установлено, первое — *{reminder_dt_moscow.strftime('%d.%m.%Y в %H:%M')}*"
+    else:
+        text = f"✅ Напоминание установлено на *{reminder_dt_moscow.strftime('%d.%m.%Y в %H:%M')}*"
+    bot.send_message(message.chat.id, text, parse_mode='Markdown', reply_markup=get_main_menu_keyboard())
+
+def process_reminder_document(message):
+    document = message.document
+    file_name = document.file_name or ""
+    if not file_name.lower().endswith((".txt", ".csv")) or (document.file_size or 0) > BULK_IMPORT_MAX_BYTES:
+        msg = bot.send_message(message.chat.id, f"❌ Пришлите .txt или .csv файл размером до {BULK_IMPORT_MAX_BYTES // 1024} КБ.", reply_markup=get_back_to_menu_keyboard())
+        bot.register_next_step_handler(msg, process_new_reminder)
+        return
+    try:
+        content = bot.download_file(bot.get_file(document.file_id).file_path)
+    except Exception as e:
+        logger.error(f"Не удалось скачать файл {file_name}: {e}")
+        bot.send_message(message.chat.id, "⚠️ Не удалось получить файл. Попробуйте позже.", reply_markup=get_main_menu_keyboard())
+        return
+    lines = [line for line in read_import_lines(file_name, content) if line.strip()]
+    import_reminders(message, lines)
+
+def import_reminders(message, lines):
+    """Массовое добавление: одна запись в хранилище и один ответ со сводкой."""
+    user_id = str(message.from_user.id)
+    if len(lines) > BULK_IMPORT_MAX_LINES:
+        msg = bot.send_message(message.chat.id, f"❌ Слишком много строк ({len(lines)}). За один раз можно добавить не больше {BULK_IMPORT_MAX_LINES}.", reply_markup=get_back_to_menu_keyboard())
+        bot.register_next_step_handler(msg, process_new_reminder)
+        return
+    parsed, rejected = parse_reminder_lines(lines)
+    new_reminders = [Reminder(str(uuid.uuid4()), user_id, dt_moscow.astimezone(utc), event, rule=rule) for dt_moscow, event, rule in parsed]
+    for rem in new_reminders:
+        reminders.add(rem)
+    if new_reminders:
+        storage.save_reminders(new_reminders)
+        schedule_reminder_jobs(new_reminders)
+    summary = f"✅ Добавлено напоминаний: {len(new_reminders)} из {len(lines)}."
+    if rejected:
+        shown = rejected[:20]
+        summary += "\n\n❌ Не распознаны строки:\n" + "\n".join(f"• {line.strip()}" for line in shown)
+        if len(rejected) > len(shown):
+            summary += f"\n…и еще {len(rejected) - len(shown)}"
+    bot.send_message(message.chat.id, summary, reply_markup=get_main_menu_keyboard())
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('rem_'))
+@timed_handler
 def handle_reminder_callback(call):
     user_id = str(call.from_user.id)
-    action, reminder_id = call.data.split('_')[1:]
-    found_rem = next((rem for rem in reminders.get(user_id, []) if rem['id'] == reminder_id), None)
-    if not found_rem:
+    action, key = call.data.split('_')[1:]
+    reminder_id, _, occurrence = key.partition('@')
+    found_rem = reminders.get(reminder_id)
+    if not found_rem or found_rem.user_id != user_id:
         bot.answer_callback_query(call.id, "Это напоминание уже неактивно.")
         bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id, text="~~" + call.message.text + "~~", parse_mode='Markdown')
         return
-    reminders[user_id].remove(found_rem)
-    save_data(reminders, 'reminders.json')
-    try: scheduler.remove_job(reminder_id)
+    if action == 'done' and found_rem.rule:
+        # Повторяющееся напоминание остается, отмечено только это срабатывание. Если оно
+        # еще впереди (кнопка из списка), переносим повтор дальше; у сработавшего перенос уже сделан
+        if occurrence == f"{found_rem.time:%Y%m%d%H%M}":
+            upcoming = advance_reminder(found_rem, datetime.now(utc))
+            if upcoming is not None:
+                try: scheduler.remove_job(reminder_job_id(found_rem))
+                except Exception as e: logger.warning(f"Не удалось удалить задачу планировщика: {e}")
+            found_rem = reminders.get(reminder_id) or found_rem
+        next_moscow = found_rem.time.astimezone(moscow_tz)
+        bot.edit_message_text(
+            chat_id=call.message.chat.id, message_id=call.message.message_id,
+            text=f"✅ Выполнено: {found_rem.text}\n🔁 Следующее: {next_moscow.strftime('%d.%m в %H:%M')}",
+            reply_markup=create_reminder_inline_keyboard(found_rem)
+        )
+        bot.answer_callback_query(call.id, "Готово!")
+        return
+    reminders.remove(reminder_id)
+    storage.delete_reminder(reminder_id)
+    try: scheduler.remove_job(reminder_job_id(found_rem))
     except Exception as e: logger.warning(f"Не удалось удалить задачу планировщика: {e}")
-    message_text = f"✅ Выполнено: {found_rem['text']}" if action == 'done' else f"🗑️ Удалено: {found_rem['text']}"
+    message_text = f"✅ Выполнено: {found_rem.text}" if action == 'done' else f"🗑️ Удалено: {found_rem.text}"
     bot.edit_message_text(chat_id=call.message.chat.id, message_id=call.message.message_id, text=message_text)
     bot.answer_callback_query(call.id, "Готово!")
 
 # --- Блок Погоды ---
 
-@bot.message_handler(func=lambda message: message.text == "🌤 Погода")
+@router.exact("🌤 Погода")
+@timed_handler
 def handle_weather_menu(message):
     bot.send_message(message.chat.id, "Выберите действие:", reply_markup=get_weather_menu_keyboard())
 
-@bot.message_handler(func=lambda message: message.text == "↩️ Назад в меню погоды")
+@router.exact("↩️ Назад в меню погоды")
+@timed_handler
 def handle_back_to_weather_menu(message):
     handle_weather_menu(message)
 
-@bot.message_handler(func=lambda message: message.text == "🌦 Погода сейчас")
+@router.exact("🌦 Погода сейчас")
+@timed_handler
 def handle_today_weather(message):
     user_id = str(message.from_user.id)
     ensure_user_data_exists(user_id)
@@ -308,7 +1697,8 @@ def handle_today_weather(message):
     forecast_text = get_and_format_24h_forecast(city)
     bot.send_message(message.chat.id, forecast_text, parse_mode='Markdown')
 
-@bot.message_handler(func=lambda message: message.text == "⚙️ Настройки погоды")
+@router.exact("⚙️ Настройки погоды")
+@timed_handler
 def handle_weather_settings(message):
     user_id = str(message.from_user.id)
     ensure_user_data_exists(user_id)
@@ -321,34 +1711,40 @@ def handle_weather_settings(message):
     )
     bot.send_message(message.chat.id, text, parse_mode='Markdown', reply_markup=get_weather_settings_keyboard(user_id))
 
-@bot.message_handler(func=lambda message: message.text == "🏙 Изменить город")
+@router.exact("🏙 Изменить город")
+@timed_handler
 def handle_change_city(message):
-    msg = bot.send_message(message.chat.id, "Введите название города:", reply_markup=types.ReplyKeyboardRemove())
+    msg = bot.send_message(message.chat.id, "Введите название города:", reply_markup=REMOVE_KEYBOARD)
     bot.register_next_step_handler(msg, process_city_input)
 
+@timed_handler
 def process_city_input(message):
     user_id = str(message.from_user.id)
-    city = message.text.strip()
-    test_url = f"https://api.openweathermap.org/data/2.5/weather?q={city}&appid={WEATHER_API_KEY}"
+    city = (message.text or "").strip()
     try:
-        if requests.get(test_url, timeout=5).status_code != 200:
-            bot.send_message(message.chat.id, f"❌ Город '{city}' не найден.", reply_markup=get_weather_menu_keyboard())
-            return
+        entry = city_resolver.resolve(city) if city else None
     except requests.RequestException:
         bot.send_message(message.chat.id, "⚠️ Не удалось проверить город.", reply_markup=get_weather_menu_keyboard())
         return
+    if entry is None:
+        bot.send_message(message.chat.id, f"❌ Город '{city}' не найден.", reply_markup=get_weather_menu_keyboard())
+        return
+    # Сохраняем каноническое название, чтобы варианты написания одного города совпадали
+    city = entry['name']
     user_settings[user_id]['city'] = city
-    save_data(user_settings, 'user_settings.json')
+    storage.save_settings(user_id, user_settings[user_id])
     bot.send_message(message.chat.id, f"✅ Город изменен на *{city}*.", parse_mode='Markdown', reply_markup=get_weather_menu_keyboard())
     # Обновляем задачу, если она была включена
     if user_settings[user_id].get('notifications_on', False):
         schedule_weather_job(user_id)
 
-@bot.message_handler(func=lambda message: message.text == "⏰ Изменить время")
+@router.exact("⏰ Изменить время")
+@timed_handler
 def handle_change_time(message):
     msg = bot.send_message(message.chat.id, "Введите новое время для ежедневных уведомлений в формате `ЧЧ:ММ` (например, `08:00` или `19.30`).", parse_mode='Markdown', reply_markup=get_back_to_menu_keyboard(weather=True))
     bot.register_next_step_handler(msg, process_time_input)
 
+@timed_handler
 def process_time_input(message):
     if message.text == "↩️ Назад в меню погоды":
         return handle_weather_menu(message)
@@ -359,7 +1755,7 @@ def process_time_input(message):
         bot.register_next_step_handler(msg, process_time_input)
         return
     user_settings[user_id]['notification_time'] = new_time
-    save_data(user_settings, 'user_settings.json')
+    storage.save_settings(user_id, user_settings[user_id])
     bot.send_message(message.chat.id, f"✅ Время уведомлений изменено на *{new_time}*.", parse_mode='Markdown')
     if user_settings[user_id].get('notifications_on', False):
         schedule_weather_job(user_id)
@@ -368,7 +1764,9 @@ def process_time_input(message):
         bot.send_message(message.chat.id, "Чтобы получать уведомления, не забудьте их включить.", reply_markup=get_weather_menu_keyboard())
 
 
-@bot.message_handler(func=lambda message: message.text.endswith("уведомления"))
+@router.exact("✅ Включить уведомления", "❌ Выключить уведомления")
+@router.pattern(r"уведомления$")  # прежнее поведение: любой текст, оканчивающийся на «уведомления»
+@timed_handler
 def handle_toggle_notifications(message):
     user_id = str(message.from_user.id)
     ensure_user_data_exists(user_id)
@@ -376,7 +1774,7 @@ def handle_toggle_notifications(message):
     current_status = user_settings[user_id].get('notifications_on', False)
     new_status = not current_status
     user_settings[user_id]['notifications_on'] = new_status
-    save_data(user_settings, 'user_settings.json')
+    storage.save_settings(user_id, user_settings[user_id])
 
     if new_status:
         schedule_weather_job(user_id)
@@ -386,93 +1784,928 @@ def handle_toggle_notifications(message):
         bot.send_message(message.chat.id, "❌ Ежедневные уведомления о погоде выключены.", reply_markup=get_weather_settings_keyboard(user_id))
 
 
-# === 7. Планировщик и фоновые задачи ===
+# Регистрируется последним: команды /start и /help проверяются раньше
+@bot.message_handler(content_types=['text'])
+def route_text_message(message):
+    router.dispatch(message)
 
-def send_reminder(user_id, reminder_data):
-    logger.info(f"Отправка напоминания {reminder_data['id']} пользователю {user_id}")
-    try:
-        text = f"🔔 *Напоминание!*\n\n_{reminder_data['text']}_"
-        bot.send_message(user_id, text, parse_mode='Markdown', reply_markup=create_reminder_inline_keyboard(reminder_data['id']))
-    except Exception as e:
-        logger.error(f"Не удалось отправить напоминание {reminder_data['id']}: {e}")
 
-def send_daily_weather_forecast(user_id):
-    logger.info(f"Отправка ежедневного прогноза погоды пользователю {user_id}")
-    user_id_str = str(user_id)
-    city = user_settings.get(user_id_str, {}).get('city', 'Москва')
-    forecast_text = get_and_format_24h_forecast(city)
-    try:
-        bot.send_message(user_id, forecast_text, parse_mode='Markdown')
-    except Exception as e:
-        logger.error(f"Не удалось отправить прогноз погоды {user_id_str}: {e}")
-        
+# === 7. Очередь исходящих сообщений ===
+
+PRIORITY_REMINDER = 0  # напоминания уходят раньше погодных рассылок
+PRIORITY_WEATHER = 1
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Забирает токен (допуская долг) и возвращает, сколько секунд нужно подождать."""
+        with self._lock:
+            self._refill(monotonic())
+            self.tokens -= 1
+            return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def try_acquire(self):
+        """Забирает токен, только если он есть (без долга)."""
+        with self._lock:
+            self._refill(monotonic())
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def idle_for(self):
+        return monotonic() - self.updated
+
+
+class OutgoingMessage:
+    __slots__ = ("chat_id", "text", "kwargs", "priority", "seq", "on_done", "check", "attempt", "enqueued_at", "attempted_at")
+
+    def __init__(self, chat_id, text, kwargs, priority, seq, on_done=None, check=None):
+        self.chat_id = chat_id
+        self.text = text
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.on_done = on_done  # on_done(sent) — итог отправки, вызывается ровно один раз
+        self.check = check  # check() перед каждой попыткой: False снимает сообщение с отправки
+        self.attempt = 0
+        self.enqueued_at = monotonic()
+        self.attempted_at = None
+
+    def sort_key(self):
+        return (self.priority, self.seq)
+
+
+class Outbox:
+    """Ограниченная очередь с приоритетами и пулом потоков-отправителей.
+
+    Соблюдает общий лимит бота и лимит на чат, учитывает retry_after из
+    ответа 429 и повторяет временные ошибки с экспоненциальной задержкой.
+
+    У каждого чата своя очередь. Поток-отправитель берет только чат, лимит
+    которого уже позволяет отправку, и лишь затем забирает общий токен:
+    длинная очередь одного чата (например, после массового импорта) не
+    занимает потоки ожиданием и не задерживает остальные чаты. Повторы тоже
+    не спят в потоке, а откладывают чат до нужного момента.
+    """
+
+    def __init__(self, workers, maxsize):
+        self.workers = workers
+        self.maxsize = maxsize
+        self._seq = itertools.count()
+        self._global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self._chats = {}  # chat_id -> куча [(priority, seq, OutgoingMessage)]
+        self._active = set()  # чаты в _due, _delayed или в отправке прямо сейчас
+        self._due = []  # куча (priority, seq, chat_id): чаты, готовые к отправке
+        self._delayed = []  # куча (ready_at, chat_id): чаты, ждущие своего лимита или повтора
+        self._chat_next = {}  # chat_id -> monotonic-время, раньше которого в чат не пишем
+        self._size = 0  # сообщений в очередях (без отправляемых прямо сейчас)
+        self._unfinished = 0  # сообщений, еще не отправленных окончательно
+        self._cond = threading.Condition()
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"outbox-{i}", daemon=True).start()
+
+    def send(self, chat_id, text, priority=PRIORITY_WEATHER, on_done=None, check=None, **kwargs):
+        """Ставит сообщение в очередь. Возвращает False, если очередь переполнена.
+
+        on_done(sent) вызывается, когда с сообщением покончено: sent=True, если
+        Telegram его принял, и False при отказе, исчерпании повторов,
+        переполнении очереди или если check() перед попыткой вернул False.
+        """
+        message = OutgoingMessage(chat_id, text, kwargs, priority, next(self._seq), on_done, check)
+        with self._cond:
+            if self._size < self.maxsize:
+                heapq.heappush(self._chats.setdefault(chat_id, []), (message.priority, message.seq, message))
+                self._size += 1
+                self._unfinished += 1
+                if chat_id not in self._active:
+                    self._active.add(chat_id)
+                    self._schedule(chat_id)
+                return True
+        metrics.inc("bot_outbox_dropped_total")
+        logger.error(f"Очередь отправки переполнена, сообщение для {chat_id} отброшено.")
+        self._done(message, False)
+        return False
+
+    def depth(self):
+        return self._size
+
+    def join(self):
+        """Ждет, пока очередь опустеет и все сообщения будут обработаны."""
+        with self._cond:
+            while self._unfinished:
+                self._cond.wait()
+
+    def _schedule(self, chat_id):
+        """Ставит чат в очередь готовых или отложенных (вызывается под self._cond)."""
+        now = monotonic()
+        ready_at = self._chat_next.get(chat_id, 0)
+        if ready_at <= now:
+            priority, seq, _ = self._chats[chat_id][0]
+            heapq.heappush(self._due, (priority, seq, chat_id))
+        else:
+            heapq.heappush(self._delayed, (ready_at, chat_id))
+        self._cond.notify()
+
+    def _take(self):
+        """Ждет чат, в который уже можно писать, и достает его первое сообщение."""
+        with self._cond:
+            while True:
+                now = monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, chat_id = heapq.heappop(self._delayed)
+                    priority, seq, _ = self._chats[chat_id][0]
+                    heapq.heappush(self._due, (priority, seq, chat_id))
+                if self._due:
+                    _, _, chat_id = heapq.heappop(self._due)
+                    _, _, message = heapq.heappop(self._chats[chat_id])
+                    self._size -= 1
+                    return message
+                self._cond.wait(self._delayed[0][0] - now if self._delayed else None)
+
+    def _release(self, message, retry_in):
+        """Возвращает чат в очередь после попытки; retry_in — через сколько повторить сообщение."""
+        chat_id = message.chat_id
+        with self._cond:
+            now = monotonic()
+            if message.attempted_at is not None:
+                self._chat_next[chat_id] = max(self._chat_next.get(chat_id, 0), message.attempted_at + 1 / TELEGRAM_CHAT_RATE)
+            if retry_in is None:
+                self._unfinished -= 1
+            else:
+                heapq.heappush(self._chats[chat_id], (message.priority, message.seq, message))
+                self._size += 1
+                self._chat_next[chat_id] = max(self._chat_next.get(chat_id, 0), now + retry_in)
+            if self._chats[chat_id]:
+                self._schedule(chat_id)
+            else:
+                del self._chats[chat_id]
+                self._active.discard(chat_id)
+            if len(self._chat_next) > 10000:
+                # Забываем давно прошедшие ограничения молчащих чатов, чтобы словарь не рос бесконечно
+                for key in [key for key, ready_at in self._chat_next.items() if ready_at < now]:
+                    del self._chat_next[key]
+            if not self._unfinished:
+                self._cond.notify_all()
+
+    def _worker(self):
+        while True:
+            message = self._take()
+            retry_in = None
+            try:
+                retry_in = self._deliver(message)
+            except Exception as e:
+                logger.error(f"Необработанная ошибка отправки для {message.chat_id}: {e}")
+                self._done(message, False)
+            finally:
+                self._release(message, retry_in)
+
+    def _deliver(self, message):
+        """Одна попытка отправки. Возвращает задержку до повтора или None, если с сообщением покончено."""
+        # Чат уже готов, ждать можно только общий лимит — он одинаков для всех чатов
+        wait = self._global_bucket.reserve()
+        if wait > 0:
+            sleep(wait)
+        if message.check is not None and not message.check():
+            logger.warning(f"Сообщение для {message.chat_id} снято с отправки: условие отправки больше не выполняется.")
+            self._done(message, False)
+            return None
+        attempt = message.attempt
+        message.attempt += 1
+        started = message.attempted_at = monotonic()
+        try:
+            bot.send_message(message.chat_id, message.text, **message.kwargs)
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                delay = e.result_json.get('parameters', {}).get('retry_after', 1)
+                logger.warning(f"429 от Telegram для {message.chat_id}, повтор через {delay} с.")
+            elif e.error_code >= 500:
+                delay = 2 ** attempt + random.random()
+            else:
+                # 400/403 (например, бот заблокирован) повторять бессмысленно
+                self._record_failure(message, e)
+                return None
+        except requests.RequestException as e:
+            delay = 2 ** attempt + random.random()
+            logger.warning(f"Сетевая ошибка при отправке {message.chat_id}: {e}")
+        else:
+            self._record_success(message, started)
+            return None
+        if attempt < OUTBOX_MAX_RETRIES:
+            metrics.inc("bot_outbox_retries_total")
+            return delay
+        self._record_failure(message, "превышено число попыток")
+        return None
+
+    def _record_success(self, message, started):
+        now = monotonic()
+        metrics.observe("bot_outbox_send_seconds", now - started)
+        metrics.observe("bot_outbox_wait_seconds", started - message.enqueued_at)
+        metrics.observe("bot_outbox_delivery_seconds", now - message.enqueued_at)
+        self._done(message, True)
+
+    def _record_failure(self, message, error):
+        metrics.inc("bot_outbox_failures_total")
+        logger.error(f"Не удалось отправить сообщение {message.chat_id}: {error}")
+        self._done(message, False)
+
+    @staticmethod
+    def _done(message, sent):
+        if message.on_done is None:
+            return
+        try:
+            message.on_done(sent)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке итога отправки для {message.chat_id}: {e}")
+
+
+outbox = Outbox(OUTBOX_WORKERS, OUTBOX_SIZE)
+
+
+# === 8. Планировщик и фоновые задачи ===
+
+_scheduled_horizon = None  # до какого момента (UTC) напоминания уже переданы планировщику
+
+def current_horizon():
+    # В кластере горизонт сдвигает ведущий экземпляр, остальные читают его из общей базы
+    if CLUSTER_MODE:
+        stored = storage.get_meta('scheduled_horizon')
+        return datetime.fromisoformat(stored) if stored else None
+    return _scheduled_horizon
+
+def due_reminders(start, end):
+    """Напоминания в (start, end]: в кластере из общей базы, иначе из индекса в памяти."""
+    if CLUSTER_MODE:
+        return storage.load_reminders_between(start, end)
+    if start is None:
+        return reminders.before(end)
+    return reminders.between(start, end)
+
+def reminder_job_id(reminder):
+    # У повтора в id задачи входит время срабатывания: следующую задачу можно добавить,
+    # пока планировщик еще не удалил отработавшую
+    if reminder.rule:
+        return f"{reminder.id}@{reminder.time:%Y%m%d%H%M}"
+    return reminder.id
+
+def schedule_reminder_jobs(new_reminders):
+    """Регистрирует задачи планировщика для пачки напоминаний внутри горизонта.
+
+    Более поздние напоминания остаются только в индексе: их зарегистрирует
+    promote_reminders, когда до них дойдет очередь.
+    """
+    horizon = current_horizon()
+    scheduled = 0
+    for rem in new_reminders:
+        if horizon is not None and rem.time > horizon:
+            continue
+        scheduler.add_job(
+            send_reminder, trigger='date', run_date=rem.time, args=[rem.id], id=reminder_job_id(rem), replace_existing=True,
+            misfire_grace_time=int(MISSED_GRACE_HOURS * 3600), coalesce=True
+        )
+        scheduled += 1
+    return scheduled
+
+def promote_reminders():
+    """Сдвигает горизонт и регистрирует напоминания, которые в него попали."""
+    global _scheduled_horizon
+    new_horizon = datetime.now(utc) + timedelta(hours=RESTORE_HORIZON_HOURS)
+    if new_horizon <= _scheduled_horizon:
+        return 0
+    # Горизонт сдвигается до выборки: напоминание, добавленное обработчиком (или другим
+    # экземпляром) в это время, либо попадет в выборку, либо будет запланировано им самим
+    # по новому горизонту. При обратном порядке оно могло не попасть ни туда, ни туда.
+    old_horizon = _scheduled_horizon
+    _scheduled_horizon = new_horizon
+    storage.set_meta('scheduled_horizon', new_horizon.isoformat())
+    promoted = due_reminders(old_horizon, new_horizon)
+    if promoted:
+        schedule_reminder_jobs(promoted)
+        logger.info(f"В планировщик добавлено {len(promoted)} напоминаний до {new_horizon:%d.%m %H:%M} UTC.")
+    return len(promoted)
+
+def compact_reminders():
+    """Удаляет давно сработавшие напоминания из памяти и хранилища."""
+    cutoff = datetime.now(utc) - timedelta(hours=REMINDER_RETENTION_HOURS)
+    if CLUSTER_MODE:
+        storage.prune_updates(time() - 24 * 3600)
+    # Повторяющиеся не устаревают: после срабатывания они переносятся вперед
+    expired = [rem for rem in due_reminders(None, cutoff) if not rem.rule]
+    if not expired:
+        return 0
+    for rem in expired:
+        reminders.remove(rem.id)
+    storage.delete_reminders([rem.id for rem in expired])
+    logger.info(f"Удалено {len(expired)} сработавших напоминаний старше {REMINDER_RETENTION_HOURS} ч.")
+    return len(expired)
+
+def send_reminder(reminder_id):
+    # Задача хранит только id: данные напоминания всегда берутся из актуального индекса
+    # (в кластере — из общей базы, напоминание могли добавить на другом экземпляре)
+    reminder = storage.load_reminder(reminder_id) if CLUSTER_MODE else reminders.get(reminder_id)
+    now = datetime.now(utc)
+    # Срабатывание в будущем значит, что повтор уже перенесли (например, при досылке пропущенных)
+    if reminder is None or reminder.delivered or reminder.time > now:
+        return
+    text = f"🔔 *Напоминание!*\n\n_{reminder.text}_"
+    # Сначала захватываем напоминание в хранилище, чтобы его не отправил второй экземпляр.
+    # Доставленным разовое напоминание станет только после ответа Telegram (settle_reminders)
+    claimed = []
+    if reminder.rule:
+        upcoming = advance_reminder(reminder, now)
+        if upcoming is None:
+            return
+        text += f"\n\n🔁 Следующее: {upcoming.time.astimezone(moscow_tz).strftime('%d.%m в %H:%M')}"
+    else:
+        claimed = storage.claim_reminders([reminder.id])
+        if not claimed:
+            return
+    user_id = reminder.user_id
+    logger.info(f"Отправка напоминания {reminder.id} пользователю {user_id}")
+    send_reminder_message(user_id, text, claimed, parse_mode='Markdown', reply_markup=create_reminder_inline_keyboard(reminder))
+
+def send_reminder_message(user_id, text, claimed_ids, **kwargs):
+    """Ставит в очередь сообщение о напоминаниях; claimed_ids — захваченные разовые среди них.
+
+    В кластере перед каждой попыткой проверяется аренда ведущего: потерявший
+    ее экземпляр не отправляет захваченное, а снимает захват, и напоминание
+    отправит только новый ведущий.
+    """
+    if not claimed_ids:
+        return outbox.send(user_id, text, priority=PRIORITY_REMINDER, **kwargs)
+    return outbox.send(
+        user_id, text, priority=PRIORITY_REMINDER,
+        on_done=functools.partial(settle_reminders, claimed_ids),
+        check=leader_lease.holds if CLUSTER_MODE else None,
+        **kwargs
+    )
+
+def settle_reminders(reminder_ids, sent):
+    """Итог отправки разовых напоминаний (вызывается очередью отправки).
+
+    Отправленные отмечаются доставленными, с неотправленных снимается захват:
+    их дошлет следующая досылка пропущенных.
+    """
+    if not sent:
+        storage.release_reminders(reminder_ids)
+        return
+    for reminder_id in reminder_ids:
+        reminder = reminders.get(reminder_id)
+        if reminder is not None:
+            reminder.delivered = True
+    storage.mark_delivered(reminder_ids)
+
+def advance_reminder(reminder, now):
+    """Переносит повторяющееся напоминание на следующее срабатывание после now.
+
+    Возвращает новую запись или None, если перенос уже сделал другой экземпляр.
+    """
+    upcoming = reminder.with_time(next_occurrence(reminder.rule, reminder.time, now))
+    if not storage.advance_reminder(reminder.id, reminder.time, upcoming.time):
+        return None
+    reminders.add(upcoming)
+    schedule_reminder_jobs([upcoming])
+    return upcoming
+
+def deliver_missed_reminders(now):
+    """Досылает напоминания, сработавшие во время простоя (в пределах MISSED_GRACE_HOURS)."""
+    grace_start = now - timedelta(hours=MISSED_GRACE_HOURS)
+    # Повторяющиеся переносятся вперед при любой политике и любом простое, иначе они застрянут в прошлом
+    advanced = [rem for rem in due_reminders(None, now) if rem.rule and advance_reminder(rem, now)]
+    missed = [rem for rem in due_reminders(grace_start, now) if not rem.rule and not rem.delivered]
+    if MISSED_POLICY == "skip":
+        # Пропущенные все равно помечаются доставленными: их задачи остались в хранилище
+        # задач и иначе сработали бы сразу после scheduler.resume()
+        if missed:
+            claimed = storage.claim_reminders([rem.id for rem in missed])
+            settle_reminders(claimed, True)
+            logger.info(f"Пропущено {len(claimed)} напоминаний, сработавших во время простоя (MISSED_POLICY=skip).")
+        return 0
+    claimed = set(storage.claim_reminders([rem.id for rem in missed])) if missed else set()
+    missed = [rem for rem in missed if rem.id in claimed] + [rem for rem in advanced if rem.time > grace_start]
+    if not missed:
+        return 0
+    missed.sort(key=Reminder.sort_key)
+
+    by_user = {}
+    for rem in missed:
+        by_user.setdefault(rem.user_id, []).append(rem)
+    for user_id, user_missed in by_user.items():
+        if MISSED_POLICY == "each" or len(user_missed) == 1:
+            for rem in user_missed:
+                text = f"🔔 *Напоминание (пропущено, {rem.time.astimezone(moscow_tz).strftime('%d.%m в %H:%M')})*\n\n_{rem.text}_"
+                send_reminder_message(user_id, text, [] if rem.rule else [rem.id], parse_mode='Markdown', reply_markup=create_reminder_inline_keyboard(rem))
+        else:
+            lines = [f"• {rem.time.astimezone(moscow_tz).strftime('%d.%m в %H:%M')} — {rem.text}" for rem in user_missed]
+            text = f"⏰ Пока бот был недоступен, вы пропустили напоминаний: {len(user_missed)}\n\n" + "\n".join(lines)
+            send_reminder_message(user_id, text, [rem.id for rem in user_missed if not rem.rule])
+    logger.info(f"Дослано {len(missed)} пропущенных напоминаний {len(by_user)} пользователям.")
+    return len(missed)
+
+class WeatherIndex:
+    """Индекс подписчиков на погоду: "ЧЧ:ММ" -> {ключ города -> {user_id}}.
+
+    Заменяет отдельную cron-задачу на каждого пользователя: раз в минуту
+    планировщик забирает одну корзину и рассылает по прогнозу на город.
+    """
+
+    def __init__(self):
+        self._buckets = {}  # time_str -> {city_key: set(user_id)}
+        self._entries = {}  # user_id -> (time_str, city_key)
+        self._lock = threading.Lock()
+
+    def add(self, user_id, time_str, city):
+        with self._lock:
+            self._discard(user_id)
+            city_key = normalize_city(city)
+            self._buckets.setdefault(time_str, {}).setdefault(city_key, set()).add(user_id)
+            self._entries[user_id] = (time_str, city_key)
+
+    def remove(self, user_id):
+        with self._lock:
+            return self._discard(user_id)
+
+    def _discard(self, user_id):
+        entry = self._entries.pop(user_id, None)
+        if entry is None:
+            return False
+        time_str, city_key = entry
+        cities = self._buckets[time_str]
+        cities[city_key].discard(user_id)
+        if not cities[city_key]:
+            del cities[city_key]
+        if not cities:
+            del self._buckets[time_str]
+        return True
+
+    def bucket(self, time_str):
+        """Снимок корзины: {ключ города: [user_id, ...]}."""
+        with self._lock:
+            return {city_key: list(user_ids) for city_key, user_ids in self._buckets.get(time_str, {}).items()}
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+weather_index = WeatherIndex()
+_last_weather_tick = None
+
+def weather_bucket(time_str):
+    """{ключ города: (название, [user_id])} для рассылки на time_str."""
+    if CLUSTER_MODE:
+        # Подписки могли измениться на других экземплярах, поэтому берем их из общей базы
+        bucket = {}
+        for user_id, city in storage.load_weather_subscribers(time_str):
+            bucket.setdefault(normalize_city(city), (city, []))[1].append(user_id)
+        return bucket
+    # Название города берем из настроек первого получателя
+    return {
+        city_key: (user_settings.get(user_ids[0], {}).get('city', 'Москва'), user_ids)
+        for city_key, user_ids in weather_index.bucket(time_str).items()
+    }
+
+def send_weather_bucket(time_str):
+    """Рассылает прогноз всем подписчикам с временем уведомления time_str."""
+    bucket = weather_bucket(time_str)
+    if not bucket:
+        return
+    logger.info(f"Рассылка погоды на {time_str} (MSK): {sum(len(user_ids) for _, user_ids in bucket.values())} получателей, {len(bucket)} городов")
+    for city, user_ids in bucket.values():
+        # Прогноз запрашивается один раз на город
+        forecast_text = get_and_format_24h_forecast(city)
+        for user_id in user_ids:
+            outbox.send(user_id, forecast_text, priority=PRIORITY_WEATHER, parse_mode='Markdown')
+
+def dispatch_weather_tick():
+    """Ежеминутная задача: отправляет корзины за все минуты с прошлого запуска."""
+    global _last_weather_tick
+    now = datetime.now(moscow_tz).replace(second=0, microsecond=0)
+    if _last_weather_tick is None:
+        minute = now
+    else:
+        # Если задача запустилась с опозданием, досылаем пропущенные минуты (не более WEATHER_CATCHUP_MINUTES)
+        minute = max(_last_weather_tick + timedelta(minutes=1), now - timedelta(minutes=WEATHER_CATCHUP_MINUTES))
+    while minute <= now:
+        send_weather_bucket(minute.strftime('%H:%M'))
+        minute += timedelta(minutes=1)
+    _last_weather_tick = now
+
 def schedule_weather_job(user_id):
     user_id_str = str(user_id)
-    job_id = f"weather_{user_id_str}"
     settings = user_settings.get(user_id_str, {})
     time_str = settings.get('notification_time', '07:30')
-    hour, minute = map(int, time_str.split(':'))
-    
-    scheduler.add_job(
-        send_daily_weather_forecast,
-        trigger='cron',
-        hour=hour,
-        minute=minute,
-        timezone=moscow_tz, # Уведомления приходят по московскому времени
-        args=[user_id],
-        id=job_id,
-        replace_existing=True
-    )
-    logger.info(f"Задача '{job_id}' запланирована на {time_str} (MSK).")
+    weather_index.add(user_id_str, time_str, settings.get('city', 'Москва'))
+    logger.info(f"Уведомления о погоде для {user_id_str} запланированы на {time_str} (MSK).")
 
 def remove_weather_job(user_id):
-    job_id = f"weather_{user_id}"
-    try:
-        scheduler.remove_job(job_id)
-        logger.info(f"Задача '{job_id}' удалена.")
-    except Exception:
-        logger.warning(f"Не удалось удалить задачу '{job_id}' (возможно, ее не существует).")
+    if weather_index.remove(str(user_id)):
+        logger.info(f"Уведомления о погоде для {user_id} отключены.")
+    else:
+        logger.warning(f"Пользователь {user_id} не был подписан на уведомления о погоде.")
+
+SYSTEM_JOB_IDS = {'weather_tick', 'promote_reminders', 'compact_reminders'}
+
+def on_scheduler_event(event):
+    """Собирает метрики планировщика: задержку запуска, ошибки и пропуски."""
+    job = event.job_id if event.job_id in SYSTEM_JOB_IDS else 'reminder'
+    if event.code == EVENT_JOB_SUBMITTED:
+        now = datetime.now(utc)
+        for run_time in event.scheduled_run_times:
+            metrics.observe("bot_job_lag_seconds", max(0.0, (now - run_time).total_seconds()), job=job)
+    elif event.code == EVENT_JOB_ERROR:
+        metrics.inc("bot_job_errors_total", job=job)
+    elif event.code == EVENT_JOB_MISSED:
+        metrics.inc("bot_job_missed_total", job=job)
+
+scheduler.add_listener(on_scheduler_event, EVENT_JOB_SUBMITTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
+
+def count_scheduler_jobs():
+    if isinstance(jobstore, SQLAlchemyJobStore):
+        # Считаем в базе, не распаковывая задачи
+        with jobstore.engine.connect() as connection:
+            return connection.execute(select(func.count()).select_from(jobstore.jobs_t)).scalar()
+    return len(scheduler.get_jobs())
+
+def restore_jobs(leader=True):
+    """Загружает состояние из хранилища и (для ведущего экземпляра) восстанавливает задачи.
+
+    С leader=False только заполняет данные в памяти: досылкой пропущенных,
+    очисткой и системными задачами займется экземпляр, получивший аренду.
+    """
+    logger.info("Восстановление задач..." if leader else "Загрузка данных (экземпляр не ведущий)...")
+    timings = {}
+    started = monotonic()
 
-def restore_jobs():
-    logger.info("Восстановление задач...")
     # Восстановление напоминаний
-    reminders.clear(); reminders.update(load_data('reminders.json', {}))
-    rem_restored = 0
-    for user_id, user_reminders in reminders.items():
-        for rem in user_reminders:
-            if datetime.fromisoformat(rem['time']) > datetime.now(utc):
-                scheduler.add_job(send_reminder, trigger='date', run_date=rem['time'], args=[rem['user_id'], rem], id=rem['id'], replace_existing=True)
-                rem_restored += 1
-    logger.info(f"Восстановлено {rem_restored} напоминаний.")
+    if isinstance(storage, SqliteStorage):
+        storage.migrate_from_json(REMINDERS_FILE, SETTINGS_FILE)
+    reminders.load(storage.load_reminders())
+    timings['загрузка напоминаний'] = monotonic() - started
+
+    if leader:
+        restore_reminder_jobs(timings)
 
     # Восстановление уведомлений о погоде
-    user_settings.clear(); user_settings.update(load_data('user_settings.json', {}))
+    started = monotonic()
+    loaded_settings = storage.load_settings()
+    user_settings.clear(); user_settings.update(loaded_settings)
+    city_resolver.load(storage.load_cities())
+    weather_index.clear()
     weather_restored = 0
     for user_id, settings in user_settings.items():
         if settings.get('notifications_on', False):
-            schedule_weather_job(user_id)
+            weather_index.add(user_id, settings.get('notification_time', '07:30'), settings.get('city', 'Москва'))
             weather_restored += 1
-    logger.info(f"Восстановлено {weather_restored} задач на уведомления о погоде.")
+    if leader:
+        scheduler.add_job(
+            dispatch_weather_tick,
+            trigger='cron',
+            minute='*',
+            timezone=moscow_tz, # Уведомления приходят по московскому времени
+            id='weather_tick',
+            replace_existing=True,
+            coalesce=True,
+            max_instances=1
+        )
+    timings['погода'] = monotonic() - started
+    logger.info(f"Восстановлено {weather_restored} подписок на уведомления о погоде.")
+    logger.info("Время восстановления: " + ", ".join(f"{name} {seconds * 1000:.0f} мс" for name, seconds in timings.items()))
+
+def restore_reminder_jobs(timings):
+    """Очистка, досылка пропущенного и задачи напоминаний — только у ведущего экземпляра."""
+    global _scheduled_horizon
+    started = monotonic()
+    compacted = compact_reminders()
+    timings['компактизация'] = monotonic() - started
+
+    started = monotonic()
+    now = datetime.now(utc)
+    missed_delivered = deliver_missed_reminders(now)
+    timings['пропущенные'] = monotonic() - started
+
+    # В планировщик идут только напоминания ближайших часов. Если задачи уже лежат
+    # в постоянном хранилище планировщика, догружается лишь окно после прошлого горизонта.
+    started = monotonic()
+    stored_horizon = storage.get_meta('scheduled_horizon')
+    if stored_horizon and scheduler.get_job('promote_reminders') is not None:
+        _scheduled_horizon = datetime.fromisoformat(stored_horizon)
+    else:
+        _scheduled_horizon = now
+    rem_restored = promote_reminders()
+    scheduler.add_job(promote_reminders, trigger='interval', minutes=PROMOTE_INTERVAL_MINUTES, id='promote_reminders', replace_existing=True, coalesce=True)
+    scheduler.add_job(compact_reminders, trigger='interval', hours=24, id='compact_reminders', replace_existing=True, coalesce=True)
+    timings['планирование напоминаний'] = monotonic() - started
+    logger.info(f"Зарегистрировано {rem_restored} новых задач напоминаний из {len(reminders)} (горизонт {RESTORE_HORIZON_HOURS} ч), удалено устаревших: {compacted}, дослано пропущенных: {missed_delivered}.")
+
+
+class LeaderLease:
+    """Аренда роли ведущего экземпляра в общей базе (режим CLUSTER_MODE).
+
+    Планировщик запущен у всех экземпляров, но на паузе: задачи, добавленные
+    любым из них, попадают в общее хранилище задач, а выполняет их только
+    держатель аренды. Если он перестает ее продлевать, через
+    LEADER_LEASE_SECONDS аренду забирает другой экземпляр и досылает
+    пропущенное. Напоминание захватывает claim_reminders, а доставленным
+    оно становится только после ответа Telegram: если ведущий упал, пока
+    оно ждало в очереди отправки, его дошлет следующий. Живой, но
+    потерявший аренду экземпляр захваченное уже не отправит (см. holds).
+    """
+
+    NAME = 'scheduler'
+
+    def __init__(self, holder, ttl, interval):
+        self.holder = holder
+        self.ttl = ttl
+        self.interval = interval
+        self.is_leader = False
+        self.valid_until = 0.0  # monotonic-время, до которого аренда точно наша
+
+    def start(self):
+        threading.Thread(target=self._run, name="leader-lease", daemon=True).start()
+
+    def _run(self):
+        while True:
+            started = monotonic()
+            try:
+                acquired = storage.acquire_lease(self.NAME, self.holder, self.ttl)
+                if acquired:
+                    self.valid_until = started + self.ttl
+            except Exception as e:
+                logger.error(f"Не удалось продлить аренду планировщика: {e}")
+                acquired = False
+            try:
+                if acquired and not self.is_leader:
+                    self._on_elected()
+                elif not acquired and self.is_leader:
+                    self._on_demoted()
+                elif acquired:
+                    # Задачи, добавленные другими экземплярами, планировщик сам не заметит
+                    scheduler.wakeup()
+            except Exception as e:
+                logger.error(f"Ошибка смены роли экземпляра {self.holder}: {e}")
+            sleep(self.interval)
+
+    def holds(self):
+        """True, если аренда наша и не истечет до следующего продления.
+
+        Проверяется перед отправкой захваченных напоминаний: экземпляр, который
+        завис или потерял аренду, но еще не заметил этого, не отправит их
+        одновременно с новым ведущим.
+        """
+        return self.is_leader and monotonic() + self.interval < self.valid_until
+
+    def _on_elected(self):
+        logger.info(f"Экземпляр {self.holder} стал ведущим, запускаю планировщик.")
+        self.is_leader = True
+        restore_jobs()
+        scheduler.resume()
+
+    def _on_demoted(self):
+        logger.warning(f"Экземпляр {self.holder} потерял аренду, планировщик на паузе.")
+        self.is_leader = False
+        scheduler.pause()
+        # Захваченные напоминания, что еще ждут в очереди отправки, снимутся перед попыткой
+        # (check=holds в send_reminder_message), и захват с них будет снят
+
+
+leader_lease = LeaderLease(INSTANCE_ID, LEADER_LEASE_SECONDS, LEADER_RENEW_SECONDS)
+
+
+# === 9. Webhook и запуск ===
+
+def get_update_chat_id(update):
+    """Чат, к которому относится апдейт (для сохранения порядка обработки)."""
+    if update.message:
+        return update.message.chat.id
+    if update.edited_message:
+        return update.edited_message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return update.update_id
+
+def get_update_user_id(update):
+    for item in (update.message, update.edited_message, update.callback_query):
+        if item is not None and item.from_user is not None:
+            return item.from_user.id
+    return None
+
+
+class UpdateDispatcher:
+    """Очередь входящих апдейтов с пулом обработчиков.
+
+    Апдейты одного чата всегда попадают в один и тот же шард, поэтому
+    диалоги через register_next_step_handler не перемешиваются. Повторы
+    Telegram отбрасываются по update_id (в кластере — и по общей базе,
+    если повтор пришел на другой экземпляр).
+    """
 
+    def __init__(self, workers, maxsize):
+        self._shards = [queue.Queue(max(1, maxsize // workers)) for _ in range(workers)]
+        self._seen = OrderedDict()
+        self._seen_lock = threading.Lock()
 
-# === 8. Webhook и запуск ===
+    def start(self):
+        for i, shard in enumerate(self._shards):
+            threading.Thread(target=self._worker, args=(shard,), name=f"updates-{i}", daemon=True).start()
+
+    def submit(self, update):
+        """Ставит апдейт в очередь. Возвращает False, если очередь переполнена."""
+        with self._seen_lock:
+            duplicate = update.update_id in self._seen
+            if not duplicate:
+                self._seen[update.update_id] = None
+                if len(self._seen) > UPDATE_DEDUP_SIZE:
+                    self._seen.popitem(last=False)
+        if duplicate or (CLUSTER_MODE and not storage.remember_update(update.update_id)):
+            metrics.inc("bot_updates_total", result="duplicate")
+            return True
+        shard = self._shards[hash(get_update_chat_id(update)) % len(self._shards)]
+        try:
+            shard.put_nowait((monotonic(), update))
+        except queue.Full:
+            with self._seen_lock:
+                # Telegram повторит апдейт, его нужно будет принять
+                self._seen.pop(update.update_id, None)
+            metrics.inc("bot_updates_total", result="rejected")
+            if CLUSTER_MODE:
+                storage.forget_update(update.update_id)
+            return False
+        metrics.inc("bot_updates_total", result="accepted")
+        return True
+
+    def depth(self):
+        return sum(shard.qsize() for shard in self._shards)
+
+    def join(self):
+        """Ждет обработки всех принятых апдейтов."""
+        for shard in self._shards:
+            shard.join()
+
+    def _worker(self, shard):
+        while True:
+            enqueued_at, update = shard.get()
+            try:
+                user_id = get_update_user_id(update)
+                if CLUSTER_MODE and user_id is not None:
+                    refresh_user_state(user_id)
+                bot.process_new_updates([update])
+            except Exception as e:
+                logger.error(f"Ошибка обработки апдейта {update.update_id}: {e}")
+            finally:
+                metrics.observe("bot_update_seconds", monotonic() - enqueued_at)
+                shard.task_done()
+
+
+update_dispatcher = UpdateDispatcher(UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+
+# Кнопки, за которыми стоит дорогая работа; остальные сообщения считаются по классу "default"
+ACTION_CLASSES = {
+    "🌦 Погода сейчас": "weather",
+    "🏙 Изменить город": "weather",
+    "➕ Добавить напоминание": "reminder",
+}
+THROTTLED_TEXT = "⏳ Слишком много запросов. Подождите немного и попробуйте снова."
+
+def get_update_action(update):
+    if update.callback_query:
+        return "callback"
+    if update.message and update.message.text:
+        return ACTION_CLASSES.get(update.message.text, "default")
+    return "default"
+
+
+class Throttler:
+    """Token bucket на пользователя и общий на класс действий, до постановки апдейта в очередь.
+
+    Состояние только в памяти: ведра пользователей, не писавших дольше
+    THROTTLE_IDLE_SECONDS, периодически удаляются (полное ведро ничем не
+    отличается от нового).
+    """
+
+    def __init__(self, limits, idle_seconds, notice_interval):
+        self._limits = limits
+        self._global = {action: TokenBucket(rate, max(1, rate)) for action, (_, _, rate) in limits.items()}
+        self._buckets = {}  # (user_id, action) -> TokenBucket
+        self._notices = {}  # user_id -> когда последний раз предупреждали
+        self._idle_seconds = idle_seconds
+        self._notice_interval = notice_interval
+        self._last_sweep = monotonic()
+        self._lock = threading.Lock()
+
+    def allow(self, user_id, action):
+        key = (user_id, action)
+        with self._lock:
+            self._maybe_sweep()
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                per_minute, burst, _ = self._limits[action]
+                bucket = self._buckets[key] = TokenBucket(per_minute / 60, burst)
+        if not bucket.try_acquire():
+            metrics.inc("bot_throttled_total", action=action, scope="user")
+            return False
+        if not self._global[action].try_acquire():
+            metrics.inc("bot_throttled_total", action=action, scope="global")
+            return False
+        return True
+
+    def should_notify(self, user_id):
+        """Предупреждение о лимите само ограничено: не чаще раза в THROTTLE_NOTICE_INTERVAL."""
+        now = monotonic()
+        with self._lock:
+            last = self._notices.get(user_id)
+            if last is not None and now - last < self._notice_interval:
+                return False
+            self._notices[user_id] = now
+            return True
+
+    def _maybe_sweep(self):
+        now = monotonic()
+        if now - self._last_sweep < self._idle_seconds:
+            return
+        self._last_sweep = now
+        for key in [key for key, bucket in self._buckets.items() if bucket.idle_for() > self._idle_seconds]:
+            del self._buckets[key]
+        for user_id in [user_id for user_id, last in self._notices.items() if now - last > self._idle_seconds]:
+            del self._notices[user_id]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+throttler = Throttler(THROTTLE_LIMITS, THROTTLE_IDLE_SECONDS, THROTTLE_NOTICE_INTERVAL)
+
+metrics.gauge("bot_active_reminders", "Напоминаний в памяти", lambda: len(reminders))
+metrics.gauge("bot_weather_subscribers", "Подписчиков на ежедневную погоду", lambda: len(weather_index))
+metrics.gauge("bot_scheduler_jobs", "Задач в планировщике", count_scheduler_jobs)
+metrics.gauge("bot_outbox_depth", "Сообщений в очереди отправки", outbox.depth)
+metrics.gauge("bot_update_queue_depth", "Апдейтов в очереди обработки", update_dispatcher.depth)
+metrics.gauge("bot_throttle_buckets", "Ведер ограничения частоты в памяти", lambda: len(throttler))
+metrics.gauge("bot_forecast_cache_entries", "Записей в кэше прогнозов", lambda: len(forecast_cache))
+metrics.gauge("bot_scheduler_leader", "Экземпляр выполняет задачи планировщика", lambda: int(not CLUSTER_MODE or leader_lease.is_leader))
+metrics.gauge("bot_weather_circuit_open", "Предохранитель сервиса погоды разомкнут", lambda: int(weather_client.breaker.is_open))
 
 @app.route(f"/{BOT_TOKEN}", methods=["POST"])
 def telegram_webhook():
+    with metrics.timer("bot_webhook_seconds"):
+        return accept_webhook_update()
+
+def accept_webhook_update():
     if request.headers.get("content-type") == "application/json":
         json_str = request.get_data().decode("utf-8")
         update = telebot.types.Update.de_json(json_str)
-        bot.process_new_updates([update])
+        user_id = get_update_user_id(update)
+        if user_id is not None and not throttler.allow(user_id, get_update_action(update)):
+            if update.callback_query:
+                # Колбэк нужно закрыть, иначе кнопка так и будет крутиться
+                try:
+                    bot.answer_callback_query(update.callback_query.id, THROTTLED_TEXT)
+                except (ApiTelegramException, requests.RequestException) as e:
+                    logger.warning(f"Не удалось ответить на отброшенный колбэк {update.callback_query.id}: {e}")
+            elif throttler.should_notify(user_id):
+                outbox.send(user_id, THROTTLED_TEXT, priority=PRIORITY_WEATHER)
+            # Отвечаем 200, чтобы Telegram не повторял отброшенный апдейт
+            return "ok", 200
+        if not update_dispatcher.submit(update):
+            logger.warning(f"Очередь апдейтов переполнена, апдейт {update.update_id} отклонен.")
+            # Telegram повторит доставку позже
+            return "Busy", 503
         return "ok", 200
     return "Invalid request", 400
 
 @app.route("/", methods=["GET"])
 def root(): return "Bot is running..."
 
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+ping_session = create_http_session(1)
+
 def self_ping():
     while True:
         try:
-            requests.head(WEBHOOK_URL, timeout=10)
+            ping_session.head(WEBHOOK_URL, timeout=10)
             logger.info(f"[PING] Self-ping successful.")
         except Exception as e:
             logger.error(f"[PING ERROR] {e}")
@@ -480,10 +2713,21 @@ def self_ping():
 
 if __name__ == "__main__":
     logger.info("Запуск бота...")
-    scheduler.start()
-    restore_jobs()
+    startup_started = monotonic()
+    outbox.start()
+    update_dispatcher.start()
+    # Планировщик на паузе, пока индекс напоминаний не загружен: задачи из постоянного хранилища ждут
+    scheduler.start(paused=True)
+    if CLUSTER_MODE:
+        # Задачи выполнит экземпляр, получивший аренду; остальные только принимают апдейты
+        restore_jobs(leader=False)
+        leader_lease.start()
+    else:
+        restore_jobs()
+        scheduler.resume()
+    webhook_started = monotonic()
     bot.remove_webhook()
     bot.set_webhook(url=WEBHOOK_URL + '/' + BOT_TOKEN)
-    logger.info(f"Вебхук установлен: {WEBHOOK_URL}")
+    logger.info(f"Вебхук установлен: {WEBHOOK_URL} за {(monotonic() - webhook_started) * 1000:.0f} мс, общий старт {(monotonic() - startup_started) * 1000:.0f} мс.")
     ping_thread = threading.Thread(target=self_ping); ping_thread.daemon = True; ping_thread.start()
     app.run(host="0.0.0.0", port=int(os.environ.get('PORT', 10000)))
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Переход с JSON-файлов прежней версии: сработавшие напоминания не должны уйти повторно."""
+
+import os
+import json
+import tempfile
+from datetime import datetime, timedelta
+
+_workdir = tempfile.mkdtemp(prefix="bot-test-")
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ["DB_PATH"] = os.path.join(_workdir, "bot.sqlite3")
+os.environ["JOBS_DB_PATH"] = ""
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def legacy_files(tmp_path):
+    """reminders.json и settings.json в формате прежней версии: без поля delivered."""
+    now = datetime.now(bot.utc)
+    old_reminders = {
+        "42": [
+            {"id": "fired", "time": (now - timedelta(hours=3)).isoformat(), "text": "Сработало при старой версии", "user_id": 42},
+            {"id": "pending", "time": (now + timedelta(hours=3)).isoformat(), "text": "Еще впереди", "user_id": 42},
+        ]
+    }
+    reminders_file = tmp_path / "reminders.json"
+    settings_file = tmp_path / "settings.json"
+    reminders_file.write_text(json.dumps(old_reminders), encoding="utf-8")
+    settings_file.write_text(json.dumps({"42": {"city": "Казань"}}), encoding="utf-8")
+    return str(reminders_file), str(settings_file)
+
+
+def test_legacy_record_without_delivered_is_delivered_if_past():
+    now = datetime.now(bot.utc)
+    fired = bot.Reminder.from_dict({"id": "a", "user_id": 1, "time": (now - timedelta(minutes=1)).isoformat(), "text": "x"})
+    pending = bot.Reminder.from_dict({"id": "b", "user_id": 1, "time": (now + timedelta(minutes=1)).isoformat(), "text": "x"})
+    assert fired.delivered is True
+    assert pending.delivered is False
+
+
+def test_explicit_delivered_flag_is_kept():
+    past = (datetime.now(bot.utc) - timedelta(minutes=1)).isoformat()
+    reminder = bot.Reminder.from_dict({"id": "a", "user_id": 1, "time": past, "text": "x", "delivered": False})
+    assert reminder.delivered is False
+
+
+def test_migration_does_not_resend_reminders_fired_before_upgrade(tmp_path, legacy_files, monkeypatch):
+    storage = bot.SqliteStorage(str(tmp_path / "upgraded.sqlite3"))
+    storage.migrate_from_json(*legacy_files)
+    migrated = {rem.id: rem for rem in storage.load_reminders()}
+    assert migrated["fired"].delivered is True
+    assert migrated["pending"].delivered is False
+
+    sent = []
+    monkeypatch.setattr(bot, "storage", storage)
+    monkeypatch.setattr(bot, "reminders", bot.ReminderIndex())
+    monkeypatch.setattr(bot.outbox, "send", lambda chat_id, text, **kwargs: sent.append((chat_id, text)) or True)
+    monkeypatch.setattr(bot, "MISSED_POLICY", "each")
+    bot.reminders.load(storage.load_reminders())
+    assert bot.deliver_missed_reminders(datetime.now(bot.utc)) == 0
+    assert sent == []
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""Правила повтора: следующее срабатывание, первое срабатывание и разбор текста."""
+
+import os
+import tempfile
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+_workdir = tempfile.mkdtemp(prefix="bot-test-")
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ["DB_PATH"] = os.path.join(_workdir, "bot.sqlite3")
+os.environ["JOBS_DB_PATH"] = ""
+
+import pytest
+
+import bot
+
+
+def msk(*args):
+    return bot.moscow_tz.localize(datetime(*args))
+
+
+def utc(*args):
+    return msk(*args).astimezone(bot.utc)
+
+
+# --- next_occurrence ---
+
+@pytest.mark.parametrize("last, expected", [
+    (utc(2027, 1, 31, 10, 0), msk(2027, 2, 28, 10, 0)),  # в феврале нет 31-го — последний день
+    (utc(2027, 2, 28, 10, 0), msk(2027, 3, 31, 10, 0)),  # после короткого месяца снова 31-е
+    (utc(2028, 1, 31, 10, 0), msk(2028, 2, 29, 10, 0)),  # високосный год
+    (utc(2027, 12, 31, 10, 0), msk(2028, 1, 31, 10, 0)),  # переход через год
+])
+def test_monthly_clamps_to_month_end(last, expected):
+    assert bot.next_occurrence("monthly:31", last) == expected
+
+
+@pytest.mark.parametrize("last, expected", [
+    (utc(2026, 10, 19, 19, 0), msk(2026, 10, 21, 19, 0)),  # пн -> ср
+    (utc(2026, 10, 21, 19, 0), msk(2026, 10, 23, 19, 0)),  # ср -> пт
+    (utc(2026, 10, 23, 19, 0), msk(2026, 10, 26, 19, 0)),  # пт -> пн следующей недели
+])
+def test_weekly_follows_day_set(last, expected):
+    assert bot.next_occurrence("weekly:0,2,4", last) == expected
+
+
+def test_weekdays_skip_weekend():
+    assert bot.next_occurrence("weekdays", utc(2026, 10, 23, 9, 30)) == msk(2026, 10, 26, 9, 30)
+
+
+def test_daily_next_day_same_time():
+    assert bot.next_occurrence("daily", utc(2026, 10, 18, 9, 0)) == msk(2026, 10, 19, 9, 0)
+
+
+def test_hours_step():
+    last = utc(2026, 10, 18, 10, 0)
+    assert bot.next_occurrence("hours:3", last) == last + timedelta(hours=3)
+
+
+@pytest.mark.parametrize("downtime, expected_steps", [
+    (timedelta(hours=10), 4),  # 10 ч простоя: пропущенные шаги не догоняем, следующий — через 12 ч
+    (timedelta(hours=9), 4),  # срабатывание ровно в now не считается — строго позже
+    (timedelta(minutes=30), 1),
+])
+def test_hours_after_downtime_stays_on_grid(downtime, expected_steps):
+    last = utc(2026, 10, 18, 10, 0)
+    assert bot.next_occurrence("hours:3", last, last + downtime) == last + timedelta(hours=3) * expected_steps
+
+
+def test_daily_after_long_downtime_skips_to_first_future_day():
+    last = utc(2026, 1, 1, 8, 0)
+    assert bot.next_occurrence("daily", last, utc(2026, 10, 18, 12, 0)) == msk(2026, 10, 19, 8, 0)
+    assert bot.next_occurrence("daily", last, utc(2026, 10, 18, 7, 0)) == msk(2026, 10, 18, 8, 0)
+
+
+def test_weekly_after_long_downtime():
+    # 18.10.2026 — воскресенье, ближайшая среда — 21-е
+    assert bot.next_occurrence("weekly:2", utc(2025, 3, 5, 19, 0), utc(2026, 10, 18, 12, 0)) == msk(2026, 10, 21, 19, 0)
+
+
+def test_monthly_after_long_downtime():
+    assert bot.next_occurrence("monthly:15", utc(2025, 1, 15, 10, 0), utc(2026, 10, 18, 12, 0)) == msk(2026, 11, 15, 10, 0)
+
+
+# --- first_occurrence ---
+
+@pytest.mark.parametrize("rule, now, expected", [
+    ("daily", msk(2026, 10, 18, 8, 0), msk(2026, 10, 18, 9, 0)),
+    ("daily", msk(2026, 10, 18, 10, 0), msk(2026, 10, 19, 9, 0)),
+    ("weekdays", msk(2026, 10, 17, 8, 0), msk(2026, 10, 19, 9, 0)),  # суббота -> понедельник
+    ("weekly:6", msk(2026, 10, 18, 8, 0), msk(2026, 10, 18, 9, 0)),  # сегодня воскресенье и время впереди
+    ("monthly:31", msk(2027, 2, 10, 8, 0), msk(2027, 2, 28, 9, 0)),
+    ("monthly:5", msk(2026, 10, 18, 8, 0), msk(2026, 11, 5, 9, 0)),
+    ("hours:3", msk(2026, 10, 18, 8, 0), msk(2026, 10, 18, 9, 0)),
+    ("hours:3", msk(2026, 10, 18, 10, 0), msk(2026, 10, 18, 12, 0)),
+])
+def test_first_occurrence(rule, now, expected):
+    assert bot.first_occurrence(rule, 9, 0, now) == expected
+
+
+# --- parse_recurring_text ---
+
+NOW = msk(2026, 10, 18, 8, 0)  # воскресенье
+
+
+@pytest.mark.parametrize("text, rule, expected, event", [
+    ("каждый день 09:00 Зарядка", "daily", msk(2026, 10, 18, 9, 0), "Зарядка"),
+    ("ежедневно 7:30 Таблетки", "daily", msk(2026, 10, 19, 7, 30), "Таблетки"),
+    ("по будням 09:30 Планерка", "weekdays", msk(2026, 10, 19, 9, 30), "Планерка"),
+    ("по пт, пн,ср 19:00 Спортзал", "weekly:0,2,4", msk(2026, 10, 19, 19, 0), "Спортзал"),
+    ("каждый месяц 15 10:00 Оплатить интернет", "monthly:15", msk(2026, 11, 15, 10, 0), "Оплатить интернет"),
+    ("ежемесячно 31-го 12:00 Отчет", "monthly:31", msk(2026, 10, 31, 12, 0), "Отчет"),
+    ("каждые 3 ч Попить воды", "hours:3", msk(2026, 10, 18, 11, 0), "Попить воды"),
+    ("каждые 2 часа 10:00 Размяться", "hours:2", msk(2026, 10, 18, 10, 0), "Размяться"),
+])
+def test_parse_recurring_text(text, rule, expected, event):
+    assert bot.parse_recurring_text(text, NOW) == (expected, event, rule)
+
+
+@pytest.mark.parametrize("text", [
+    "19:30 Позвонить бабушке",  # разовое
+    "каждый день Зарядка",  # для повторов по дням нужно время
+    "каждые 25 ч Слишком редко",
+    "каждые 0 ч Слишком часто",
+    "каждый месяц 32 10:00 Нет такого числа",
+])
+def test_parse_recurring_text_rejects(text):
+    assert bot.parse_recurring_text(text, NOW) is None
+
+
+# --- «Выполнено» на повторе ---
+
+@pytest.fixture
+def recurring(monkeypatch):
+    edited = []
+    monkeypatch.setattr(bot.bot, "edit_message_text", lambda **kwargs: edited.append(kwargs))
+    monkeypatch.setattr(bot.bot, "answer_callback_query", lambda *args, **kwargs: None)
+    rem = bot.Reminder("rec-1", 42, datetime.now(bot.utc).replace(second=0, microsecond=0) + timedelta(hours=1), "Зарядка", rule="daily")
+    bot.reminders.add(rem)
+    bot.storage.save_reminder(rem)
+    yield rem, edited
+    bot.reminders.remove(rem.id)
+    bot.storage.delete_reminder(rem.id)
+
+
+def press(key, action="done"):
+    message = SimpleNamespace(chat=SimpleNamespace(id=42), message_id=1, text="Зарядка")
+    bot.handle_reminder_callback(SimpleNamespace(id="1", data=f"rem_{action}_{key}", from_user=SimpleNamespace(id=42), message=message))
+
+
+def test_done_on_upcoming_occurrence_advances_series(recurring):
+    rem, edited = recurring
+    press(bot.reminder_job_id(rem))
+    upcoming = bot.reminders.get(rem.id)
+    assert upcoming.time == rem.time + timedelta(days=1)
+    assert bot.storage.load_reminder(rem.id).time == upcoming.time
+    # Кнопки остаются: серию можно удалить из того же сообщения
+    buttons = edited[-1]["reply_markup"].keyboard[0]
+    assert [button.callback_data for button in buttons] == [f"rem_done_{bot.reminder_job_id(upcoming)}", f"rem_delete_{bot.reminder_job_id(upcoming)}"]
+
+
+def test_done_on_fired_occurrence_keeps_next(recurring):
+    rem, edited = recurring
+    fired = rem.with_time(rem.time - timedelta(days=1))
+    press(bot.reminder_job_id(fired))
+    assert bot.reminders.get(rem.id).time == rem.time
+    assert edited[-1]["reply_markup"] is not None
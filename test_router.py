@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Каждая кнопка клавиатур должна попадать в тот же обработчик, что и до TextRouter."""
+
+import os
+import json
+import tempfile
+
+_workdir = tempfile.mkdtemp(prefix="bot-test-")
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ["DB_PATH"] = os.path.join(_workdir, "bot.sqlite3")
+os.environ["JOBS_DB_PATH"] = ""
+
+import pytest
+
+import bot
+
+EXPECTED_ROUTES = {
+    "📋 Мои напоминания": bot.handle_reminders_menu,
+    "➕ Добавить напоминание": bot.handle_reminders_menu,
+    "🌤 Погода": bot.handle_weather_menu,
+    "🌦 Погода сейчас": bot.handle_today_weather,
+    "⚙️ Настройки погоды": bot.handle_weather_settings,
+    "↩️ Назад в меню": bot.handle_back_to_main_menu,
+    "↩️ Назад в меню погоды": bot.handle_back_to_weather_menu,
+    "🏙 Изменить город": bot.handle_change_city,
+    "⏰ Изменить время": bot.handle_change_time,
+    "✅ Включить уведомления": bot.handle_toggle_notifications,
+    "❌ Выключить уведомления": bot.handle_toggle_notifications,
+}
+
+KEYBOARDS = {
+    "MAIN_MENU_KEYBOARD": bot.MAIN_MENU_KEYBOARD,
+    "WEATHER_MENU_KEYBOARD": bot.WEATHER_MENU_KEYBOARD,
+    "WEATHER_SETTINGS_KEYBOARDS[False]": bot.WEATHER_SETTINGS_KEYBOARDS[False],
+    "WEATHER_SETTINGS_KEYBOARDS[True]": bot.WEATHER_SETTINGS_KEYBOARDS[True],
+    "BACK_TO_MENU_KEYBOARD": bot.BACK_TO_MENU_KEYBOARD,
+    "BACK_TO_WEATHER_MENU_KEYBOARD": bot.BACK_TO_WEATHER_MENU_KEYBOARD,
+}
+
+
+def keyboard_labels(markup):
+    return [button["text"] for row in json.loads(markup)["keyboard"] for button in row]
+
+
+BUTTONS = [(name, label) for name, markup in KEYBOARDS.items() for label in keyboard_labels(markup)]
+
+
+@pytest.mark.parametrize("keyboard, label", BUTTONS)
+def test_keyboard_button_routes_to_handler(keyboard, label):
+    handler, match = bot.router.resolve(label)
+    assert handler is EXPECTED_ROUTES[label]
+    assert match == "exact"
+
+
+def test_every_keyboard_has_buttons():
+    assert all(keyboard_labels(markup) for markup in KEYBOARDS.values())
+
+
+def test_notifications_suffix_falls_back_to_pattern():
+    handler, match = bot.router.resolve("Включить уведомления")
+    assert handler is bot.handle_toggle_notifications
+    assert match == "pattern"
+
+
+def test_unknown_text_is_not_routed():
+    assert bot.router.resolve("привет") == (None, None)
+    assert bot.router.resolve("") == (None, None)